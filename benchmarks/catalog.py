@@ -0,0 +1,170 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Synthetic catalog generator for capacity testing
+
+Generates any number of Products in chunks, so memory stays bounded, and
+writes them to a CSV file or straight into the database. The same seed and
+chunk size always give the same catalog.
+
+Distributions:
+--------------
+category - Zipf-like, a few categories hold most of the catalog
+popularity - Pareto, a few products sell most, popular products are stocked deeper
+price - log-normal around a typical price per category
+stock - proportional to popularity, with a share of sold out products
+updated_at - spread over the year after CATALOG_START
+
+Usage:
+------
+python -m benchmarks.catalog --count 1000000 --seed 1 --csv catalog.csv
+python -m benchmarks.catalog --count 1000000 --database-uri postgres://...
+"""
+
+import io
+import os
+import sys
+import csv
+import math
+import random
+import argparse
+from itertools import accumulate
+from datetime import datetime, timedelta
+
+COLUMNS = ('name', 'category', 'price', 'price_cents', 'stock', 'description', 'stock_shards',
+           'updated_at')
+
+# Categories with the median price of their products
+CATEGORIES = [
+    ('food', 6), ('cloth', 35), ('electronic', 180), ('pet', 18), ('Health Care', 12),
+    ('beauty', 22), ('toys', 25), ('books', 15), ('home', 45), ('garden', 30),
+    ('sports', 55), ('office', 9), ('auto', 70), ('music', 20), ('baby', 28),
+    ('jewelry', 120), ('tools', 40), ('shoes', 60), ('games', 50), ('furniture', 250)
+]
+ZIPF_EXPONENT = 1.1
+CATEGORY_WEIGHTS = list(accumulate(1 / rank ** ZIPF_EXPONENT
+                                   for rank in range(1, len(CATEGORIES) + 1)))
+PRICE_SIGMA = 0.6
+POPULARITY_ALPHA = 1.2
+SOLD_OUT = 0.08
+CATALOG_START = datetime(2019, 1, 1)
+
+ADJECTIVES = ['Classic', 'Organic', 'Smart', 'Compact', 'Deluxe', 'Eco', 'Premium',
+              'Vintage', 'Wireless', 'Handmade', 'Travel', 'Family', 'Mini', 'Pro']
+NOUNS = ['Kit', 'Set', 'Pack', 'Box', 'Bundle', 'Edition', 'Collection', 'Model',
+         'Series', 'Selection']
+DESCRIPTIONS = ['A best seller in {}', 'Everyday essentials for {}',
+                'New arrival in {}', 'Limited run for {} fans', 'Our pick in {}']
+
+
+def generate(count, seed=1, chunk_size=10000):
+    """
+    Generates count products as rows of COLUMNS, one chunk at a time
+    Yields lists of at most chunk_size rows
+    """
+    rng = random.Random(seed)
+    for start in range(0, count, chunk_size):
+        size = min(chunk_size, count - start)
+        categories = rng.choices(range(len(CATEGORIES)), cum_weights=CATEGORY_WEIGHTS, k=size)
+        popularity = [rng.paretovariate(POPULARITY_ALPHA) for _ in range(size)]
+        noise = [rng.gauss(0, PRICE_SIGMA) for _ in range(size)]
+        sold_out = [rng.random() < SOLD_OUT for _ in range(size)]
+        words = rng.choices(range(len(ADJECTIVES) * len(NOUNS)), k=size)
+        templates = rng.choices(DESCRIPTIONS, k=size)
+        seconds = [rng.randrange(365 * 86400) for _ in range(size)]
+        rows = []
+        for offset in range(size):
+            category, median = CATEGORIES[categories[offset]]
+            adjective, noun = divmod(words[offset], len(NOUNS))
+            price = '{:.2f}'.format(max(0.5, round(median * math.exp(noise[offset]), 2)))
+            stock = 0 if sold_out[offset] else min(10000, int(popularity[offset] * 5))
+            rows.append(('{} {} {} {}'.format(ADJECTIVES[adjective], category, NOUNS[noun],
+                                              start + offset + 1)[:50],
+                         category, price, int(price.replace('.', '')), stock,
+                         templates[offset].format(category), 0,
+                         CATALOG_START + timedelta(seconds=seconds[offset])))
+        yield rows
+
+
+def write_csv(chunks, output):
+    """ Writes the chunks as CSV with a header, returns the number of rows """
+    writer = csv.writer(output)
+    writer.writerow(COLUMNS)
+    total = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        total += len(rows)
+    return total
+
+
+def load_database(chunks):
+    """
+    Inserts the chunks into the product table of the app, a transaction each
+    PostgreSQL loads every chunk with COPY, other databases with executemany
+    """
+    from service.model import Product, CategoryStats, db
+    table = Product.__table__
+    total = 0
+    for rows in chunks:
+        if db.engine.dialect.name == 'postgresql':
+            buffer = io.StringIO()
+            csv.writer(buffer).writerows(rows)
+            buffer.seek(0)
+            connection = db.engine.raw_connection()
+            try:
+                connection.cursor().copy_expert(
+                    'COPY {} ({}) FROM STDIN WITH CSV'.format(table.name, ', '.join(COLUMNS)),
+                    buffer)
+                connection.commit()
+            finally:
+                connection.close()
+        else:
+            with db.engine.begin() as connection:
+                connection.execute(table.insert(), [dict(zip(COLUMNS, row)) for row in rows])
+        total += len(rows)
+    if CategoryStats.enabled:
+        CategoryStats.rebuild()
+    return total
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Generate a synthetic Product catalog')
+    parser.add_argument('--count', type=int, required=True,
+                        help='The number of products to generate')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='The seed that makes the catalog reproducible')
+    parser.add_argument('--chunk-size', type=int, default=10000,
+                        help='The number of products generated and written at a time')
+    target = parser.add_mutually_exclusive_group(required=True)
+    target.add_argument('--csv', help='Write the products to this CSV file, - for stdout')
+    target.add_argument('--database-uri', help='Insert the products into this database')
+    args = parser.parse_args(argv)
+    chunks = generate(args.count, args.seed, args.chunk_size)
+    if args.csv == '-':
+        total = write_csv(chunks, sys.stdout)
+    elif args.csv:
+        with open(args.csv, 'w', newline='') as output:
+            total = write_csv(chunks, output)
+    else:
+        os.environ['DATABASE_URI'] = args.database_uri
+        from service.service import init_db
+        init_db()
+        total = load_database(chunks)
+    print('Generated {} products'.format(total), file=sys.stderr)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
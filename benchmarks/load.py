@@ -0,0 +1,333 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+End to end load test of the REST API
+
+Starts the service on a local port against SQLite or a local PostgreSQL,
+seeds it with ProductFactory and drives a mix of requests at a fixed
+concurrency. Prints throughput and latency percentiles per endpoint as JSON
+so that runs of different commits can be compared.
+
+Usage:
+------
+python -m benchmarks.load --products 1000 --concurrency 8 --requests 5000 \
+    --mix list=10,get=50,search=20,create=5,update=10,buy=5 --output load.json
+"""
+
+import os
+import sys
+import json
+import math
+import time
+import random
+import logging
+import argparse
+import tempfile
+import threading
+from collections import defaultdict
+
+DEFAULT_MIX = 'list=10,get=50,search=20,create=5,update=10,buy=5'
+CATEGORIES = ['food', 'cloth', 'electronic', 'pet']
+
+
+def parse_mix(value):
+    """ Parses a traffic mix written as 'get=50,buy=5' into weights """
+    mix = {}
+    for item in value.split(','):
+        if not item.strip():
+            continue
+        operation, _, weight = item.partition('=')
+        operation = operation.strip()
+        if operation not in OPERATIONS:
+            raise argparse.ArgumentTypeError('Unknown operation {}'.format(operation))
+        mix[operation] = float(weight or 1)
+    if not mix or sum(mix.values()) <= 0:
+        raise argparse.ArgumentTypeError('The mix needs at least one operation')
+    return mix
+
+
+def percentile(ordered, fraction):
+    """ Nearest rank percentile of an ordered list """
+    if not ordered:
+        return None
+    rank = max(0, min(len(ordered) - 1, int(math.ceil(fraction * len(ordered))) - 1))
+    return ordered[rank]
+
+
+######################################################################
+# Traffic
+######################################################################
+def product_payload(rng):
+    return {'name': 'load-{}'.format(rng.randrange(1 << 30)),
+            'category': rng.choice(CATEGORIES),
+            'price': round(rng.uniform(0, 75), 2),
+            'stock': rng.randrange(0, 50),
+            'description': 'Created by the load test'}
+
+
+def do_list(client, rng, ids):
+    return client.get('/products')
+
+
+def do_get(client, rng, ids):
+    return client.get('/products/{}'.format(rng.choice(ids)))
+
+
+def do_search(client, rng, ids):
+    return client.get('/products', params={'category': rng.choice(CATEGORIES)})
+
+
+def do_create(client, rng, ids):
+    return client.post('/products', json=product_payload(rng))
+
+
+def do_update(client, rng, ids):
+    return client.put('/products/{}'.format(rng.choice(ids)), json=product_payload(rng))
+
+
+def do_buy(client, rng, ids):
+    return client.put('/products/{}/buy'.format(rng.choice(ids)))
+
+
+OPERATIONS = {
+    'list': do_list,
+    'get': do_get,
+    'search': do_search,
+    'create': do_create,
+    'update': do_update,
+    'buy': do_buy
+}
+
+
+class Client(object):
+    """ A keep-alive HTTP session bound to the base URL of the service """
+
+    def __init__(self, base_url, api_key):
+        import requests
+        self.base_url = base_url
+        self.session = requests.Session()
+        self.session.headers['X-Api-Key'] = api_key
+
+    def get(self, path, **kwargs):
+        return self.session.get(self.base_url + path, **kwargs)
+
+    def post(self, path, **kwargs):
+        return self.session.post(self.base_url + path, **kwargs)
+
+    def put(self, path, **kwargs):
+        return self.session.put(self.base_url + path, **kwargs)
+
+
+class Recorder(object):
+    """ Collects the latency of every request per operation """
+
+    def __init__(self):
+        self.latencies = defaultdict(list)
+        self.errors = defaultdict(int)
+        self.lock = threading.Lock()
+
+    def record(self, operation, seconds, ok):
+        with self.lock:
+            self.latencies[operation].append(seconds)
+            if not ok:
+                self.errors[operation] += 1
+
+    def report(self, elapsed):
+        """ Summarizes the run with latencies in milliseconds """
+        endpoints = {}
+        for operation, latencies in sorted(self.latencies.items()):
+            ordered = sorted(latencies)
+            endpoints[operation] = {
+                'requests': len(ordered),
+                'errors': self.errors[operation],
+                'throughput': round(len(ordered) / elapsed, 2),
+                'mean_ms': round(sum(ordered) / len(ordered) * 1000, 3),
+                'p50_ms': round(percentile(ordered, 0.50) * 1000, 3),
+                'p95_ms': round(percentile(ordered, 0.95) * 1000, 3),
+                'p99_ms': round(percentile(ordered, 0.99) * 1000, 3),
+                'max_ms': round(ordered[-1] * 1000, 3)
+            }
+        total = sum(len(latencies) for latencies in self.latencies.values())
+        return {
+            'requests': total,
+            'errors': sum(self.errors.values()),
+            'seconds': round(elapsed, 3),
+            'throughput': round(total / elapsed, 2) if elapsed else None,
+            'endpoints': endpoints
+        }
+
+
+def worker(client, mix, ids, recorder, budget, deadline, seed):
+    """ Sends requests until the shared budget or the deadline runs out """
+    rng = random.Random(seed)
+    operations = list(mix)
+    weights = [mix[operation] for operation in operations]
+    while budget.take() and (deadline is None or time.monotonic() < deadline):
+        operation = rng.choices(operations, weights)[0]
+        start = time.perf_counter()
+        try:
+            resp = OPERATIONS[operation](client, rng, ids)
+            ok = resp.status_code < 500
+            if operation == 'create' and resp.status_code == 201:
+                ids.append(resp.json()['id'])
+        except Exception:  # pylint: disable=broad-except
+            ok = False
+        recorder.record(operation, time.perf_counter() - start, ok)
+
+
+class Budget(object):
+    """ The number of requests left to send, shared by the workers """
+
+    def __init__(self, count):
+        self.count = count
+        self.lock = threading.Lock()
+
+    def take(self):
+        if self.count is None:
+            return True
+        with self.lock:
+            if self.count <= 0:
+                return False
+            self.count -= 1
+            return True
+
+
+######################################################################
+# Service
+######################################################################
+def start_service(database_uri, port):
+    """
+    Starts the service in this process on a background thread
+    The environment is set before the app is imported so that its
+    configuration picks it up, with rate limiting turned off
+    """
+    os.environ['DATABASE_URI'] = database_uri
+    os.environ['RATE_LIMITS'] = ''
+    from werkzeug.serving import make_server
+    from service import app
+    from service.service import init_db
+    init_db()
+    server = make_server('127.0.0.1', port, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='load-test-server')
+    thread.daemon = True
+    thread.start()
+    return app, server
+
+
+class DatabaseNotEmpty(Exception):
+    """ Raised when seeding would delete the Products of a database """
+
+
+def seed_products(count, seed, reset=False):
+    """
+    Fills the catalog with count products from ProductFactory
+    A database that holds Products is only emptied first when reset is set
+    """
+    random.seed(seed)
+    from service.model import Product, db
+    from tests.product_factory import ProductFactory
+    if db.session.query(Product.id).first() is not None:
+        if not reset:
+            db.session.remove()
+            raise DatabaseNotEmpty('The database holds products, pass --reset to delete them')
+        Product.delete_all()
+    for start in range(0, count, 1000):
+        products = [ProductFactory() for _ in range(min(1000, count - start))]
+        for product in products:
+            product.id = None
+        db.session.add_all(products)
+        db.session.commit()
+    ids = [row.id for row in db.session.query(Product.id)]
+    db.session.remove()
+    return ids
+
+
+def run(args):
+    """ Seeds the service, runs the load and returns the report """
+    app, server = start_service(args.database_uri, args.port)
+    try:
+        ids = seed_products(args.products, args.seed, args.reset)
+        base_url = 'http://127.0.0.1:{}'.format(server.server_port)
+        recorder = Recorder()
+        budget = Budget(None if args.duration else args.requests)
+        deadline = time.monotonic() + args.duration if args.duration else None
+        threads = [threading.Thread(target=worker,
+                                    args=(Client(base_url, app.config['API_KEY']), args.mix,
+                                          ids, recorder, budget, deadline, args.seed + number))
+                   for number in range(args.concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        report = recorder.report(time.perf_counter() - start)
+    finally:
+        server.shutdown()
+    report['config'] = {
+        'database': args.database_uri.split(':', 1)[0],
+        'products': args.products,
+        'concurrency': args.concurrency,
+        'mix': args.mix,
+        'seed': args.seed
+    }
+    return report
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Load test the Product Service')
+    parser.add_argument('--database-uri', default=None,
+                        help='SQLAlchemy URI, a temporary SQLite file by default')
+    parser.add_argument('--products', type=int, default=1000,
+                        help='The number of products to seed')
+    parser.add_argument('--reset', action='store_true',
+                        help='Delete the products of a --database-uri that is not empty')
+    parser.add_argument('--mix', type=parse_mix, default=parse_mix(DEFAULT_MIX),
+                        help='Weights of list, get, search, create, update and buy')
+    parser.add_argument('--concurrency', type=int, default=8,
+                        help='The number of clients sending requests at once')
+    parser.add_argument('--requests', type=int, default=2000,
+                        help='The total number of requests to send')
+    parser.add_argument('--duration', type=float, default=None,
+                        help='Send requests for this many seconds instead')
+    parser.add_argument('--port', type=int, default=0,
+                        help='The port to serve on, any free port by default')
+    parser.add_argument('--seed', type=int, default=1,
+                        help='Seed of the catalog and of the request sequence')
+    parser.add_argument('--output', default=None,
+                        help='Write the JSON report to this file instead of stdout')
+    parser.add_argument('--verbose', action='store_true',
+                        help='Keep the request logging of the service')
+    args = parser.parse_args(argv)
+    if args.database_uri is None:
+        path = os.path.join(tempfile.mkdtemp(prefix='product-load-'), 'load.db')
+        args.database_uri = 'sqlite:///' + path
+    if not args.verbose:
+        # logging still runs up to the level check, the handlers are skipped
+        logging.disable(logging.INFO)
+    try:
+        report = run(args)
+    except DatabaseNotEmpty as error:
+        parser.error(str(error))
+    text = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text + '\n')
+    else:
+        print(text)
+    return 1 if report['errors'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
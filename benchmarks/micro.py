@@ -0,0 +1,177 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Micro-benchmarks of the code that runs on every request
+
+Times Product.serialize, Product.deserialize, marshalling of product_model,
+RobustFormatter.format and a log record fanned out to the MyFileHandler of
+every level. The best time per call of each benchmark is compared with a
+stored baseline and the run fails when one got slower than the threshold.
+
+Usage:
+------
+python -m benchmarks.micro --save       # record the baseline of this machine
+python -m benchmarks.micro              # compare with the baseline
+"""
+
+import os
+import sys
+import json
+import timeit
+import logging
+import argparse
+import tempfile
+from datetime import datetime
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baseline.json')
+
+PRODUCT = {
+    'id': 7,
+    'name': 'shampos',
+    'stock': 12,
+    'price': 12.34,
+    'description': 'Fresh smelling shampoo for every hair type',
+    'category': 'Health Care'
+}
+
+
+######################################################################
+# Benchmarks
+######################################################################
+def bench_serialize():
+    from service.model import Product
+    product = Product(stock_shards=0, updated_at=datetime(2019, 11, 1, 12, 30), **PRODUCT)
+    return product.serialize
+
+
+def bench_deserialize():
+    from service.model import Product
+    product = Product(stock_shards=0)
+    return lambda: product.deserialize(PRODUCT)
+
+
+def bench_marshal():
+    from flask_restplus import marshal
+    from service.model import Product
+    from service.service import product_model
+    data = Product(stock_shards=0, updated_at=datetime(2019, 11, 1, 12, 30),
+                   **PRODUCT).serialize()
+    return lambda: marshal(data, product_model)
+
+
+def bench_formatter():
+    from loggin.logger import RobustFormatter
+    formatter = RobustFormatter()
+    record = logging.LogRecord('service', logging.INFO, __file__, 1,
+                               'Request to create a product %s', ('shampos',), None)
+    return lambda: formatter.format(record)
+
+
+def bench_file_handlers():
+    """ A record offered to the info, debug and error files like the app logger does """
+    from loggin.logger import MyFileHandler, get_logger_settings
+    settings = get_logger_settings(tempfile.mkdtemp(prefix='product-bench-'), False)
+    formatter = logging.Formatter(settings['formatters']['fmt']['format'],
+                                  settings['formatters']['fmt']['datefmt'])
+    logger = logging.Logger('bench')
+    for name in settings['root']['handlers']:
+        config = settings['handlers'][name]
+        handler = MyFileHandler(config['filename'])
+        handler.setLevel(config['level'])
+        handler.setFormatter(formatter)
+        logger.addHandler(handler)
+    return lambda: logger.info('Request to create a product %s', 'shampos')
+
+
+BENCHMARKS = {
+    'product.serialize': bench_serialize,
+    'product.deserialize': bench_deserialize,
+    'marshal.product_model': bench_marshal,
+    'RobustFormatter.format': bench_formatter,
+    'MyFileHandler.fan_out': bench_file_handlers
+}
+
+
+def measure(setup, repeat):
+    """ Returns the best time of a call in microseconds over repeat rounds """
+    timer = timeit.Timer(setup())
+    number, _ = timer.autorange()
+    return min(timer.repeat(repeat, number)) / number * 1e6
+
+
+def compare(results, baseline, threshold):
+    """
+    Compares results with a baseline
+    Returns a row per benchmark and whether any of them regressed
+    """
+    rows = []
+    failed = False
+    for name, micros in results.items():
+        base = baseline.get(name)
+        ratio = micros / base if base else None
+        regressed = ratio is not None and ratio > threshold
+        failed = failed or regressed
+        rows.append({'benchmark': name, 'us': round(micros, 3),
+                     'baseline_us': base and round(base, 3),
+                     'ratio': ratio and round(ratio, 3), 'regressed': regressed})
+    return rows, failed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Micro-benchmarks of the Product Service')
+    parser.add_argument('names', nargs='*',
+                        help='The benchmarks to run, all of them by default')
+    parser.add_argument('--baseline', default=BASELINE,
+                        help='The file the baseline is kept in')
+    parser.add_argument('--save', action='store_true',
+                        help='Store the results as the new baseline')
+    parser.add_argument('--threshold', type=float, default=1.3,
+                        help='Fail when a benchmark takes this many times its baseline')
+    parser.add_argument('--repeat', type=int, default=7,
+                        help='Rounds per benchmark, the best one counts')
+    args = parser.parse_args(argv)
+    unknown = set(args.names) - set(BENCHMARKS)
+    if unknown:
+        parser.error('unknown benchmarks: {}, choose from {}'.format(
+            ', '.join(sorted(unknown)), ', '.join(sorted(BENCHMARKS))))
+    os.environ.setdefault('DATABASE_URI', 'sqlite://')
+    # loggin imports the app, so the app has to be set up first
+    import service  # pylint: disable=unused-import
+    results = {name: measure(BENCHMARKS[name], args.repeat)
+               for name in (args.names or sorted(BENCHMARKS))}
+    if args.save:
+        baseline = {}
+        if os.path.exists(args.baseline):
+            with open(args.baseline) as stored:
+                baseline = json.load(stored)
+        baseline.update(results)
+        with open(args.baseline, 'w') as stored:
+            json.dump(baseline, stored, indent=2, sort_keys=True)
+            stored.write('\n')
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as stored:
+            baseline = json.load(stored)
+    rows, failed = compare(results, baseline, args.threshold)
+    for row in rows:
+        print('{benchmark:<24} {us:>10.3f} us  baseline {0:>10}  ratio {1:>6}{2}'.format(
+            row['baseline_us'] if row['baseline_us'] is not None else '-',
+            row['ratio'] if row['ratio'] is not None else '-',
+            '  REGRESSED' if row['regressed'] else '', **row))
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
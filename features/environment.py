@@ -4,10 +4,11 @@ Environment for Behave Testing
 import os
 from behave import *
 from selenium import webdriver
-from service.service import get_apikey_for_behave
 
 WAIT_SECONDS = 120
 BASE_URL = os.getenv('BASE_URL', 'http://nyu-product-service-f19-dev.mybluemix.net/')
+# The key of the service under test, which runs in a process of its own
+API_KEY = os.getenv('API_KEY')
 
 def before_all(context):
     """ Executed once before all tests """
@@ -28,5 +29,5 @@ def before_all(context):
     context.driver.implicitly_wait(WAIT_SECONDS) # seconds
     # context.driver.set_window_size(1120, 550)
     context.base_url = BASE_URL
-    context.API_KEY = get_apikey_for_behave()
+    context.API_KEY = API_KEY
 
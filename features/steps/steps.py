@@ -16,7 +16,6 @@ from selenium.webdriver.common.by import By
 from selenium.webdriver.support.ui import WebDriverWait
 from selenium.webdriver.support.ui import Select
 from selenium.webdriver.support import expected_conditions
-from service.service import get_apikey_for_behave
 import sys
 
 WAIT_SECONDS = int(getenv('WAIT_SECONDS', '60'))
@@ -55,6 +54,9 @@ def step_impl(context):
     """ Make a call to the base URL """
     context.driver.get(context.base_url)
     # context.driver.save_screenshot('home_page.png')
+    element = context.driver.find_element_by_id('api_key')
+    element.clear()
+    element.send_keys(context.API_KEY)
 
 
 @when('I set the "{element_name}" to "{text_string}"')
@@ -3,6 +3,56 @@ CREATE TABLE product (
     name           VARCHAR(50),
     stock          INTEGER,
     price          DECIMAL(18,2),
+    price_cents    BIGINT,
     description    VARCHAR(255),
-    category       VARCHAR(50)
+    category       VARCHAR(50),
+    stock_shards   INTEGER NOT NULL DEFAULT 0,
+    updated_at     TIMESTAMP NOT NULL DEFAULT (now() AT TIME ZONE 'utc')
+);
+
+CREATE INDEX ix_product_category ON product (category);
+CREATE INDEX ix_product_updated_at_id ON product (updated_at, id);
+CREATE INDEX ix_product_name_id ON product (name, id);
+CREATE INDEX ix_product_price_id ON product (price, id);
+CREATE INDEX ix_product_category_name_id ON product (category, name, id);
+CREATE INDEX ix_product_category_price_id ON product (category, price, id);
+CREATE INDEX ix_product_price_cents_id ON product (price_cents, id);
+CREATE INDEX ix_product_category_price_cents_id ON product (category, price_cents, id);
+
+CREATE TABLE tombstone (
+    product_id     INTEGER PRIMARY KEY,
+    deleted_at     TIMESTAMP NOT NULL
+);
+
+CREATE INDEX ix_tombstone_deleted_at_product_id ON tombstone (deleted_at, product_id);
+
+CREATE TABLE stock_shard (
+    product_id     INTEGER REFERENCES product (id),
+    slot           INTEGER,
+    stock          INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (product_id, slot)
+);
+
+CREATE TABLE category_stats (
+    category       VARCHAR(50) PRIMARY KEY,
+    count          INTEGER NOT NULL DEFAULT 0,
+    stock          BIGINT NOT NULL DEFAULT 0,
+    stock_value    DECIMAL(28,2) NOT NULL DEFAULT 0,
+    price_total    DECIMAL(28,2) NOT NULL DEFAULT 0,
+    min_price      DECIMAL(18,2),
+    max_price      DECIMAL(18,2)
+);
+
+CREATE TABLE api_key (
+    id             SERIAL PRIMARY KEY,
+    name           VARCHAR(50) NOT NULL,
+    key_hash       VARCHAR(64) NOT NULL UNIQUE,
+    scopes         VARCHAR(255) NOT NULL DEFAULT '',
+    revoked        BOOLEAN NOT NULL DEFAULT FALSE,
+    created        TIMESTAMP NOT NULL
+);
+
+CREATE TABLE api_key_version (
+    id             INTEGER PRIMARY KEY,
+    version        INTEGER NOT NULL DEFAULT 0
 );
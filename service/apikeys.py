@@ -0,0 +1,119 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Verification of API keys
+Keys are looked up by their digest in the api_key table and the result is
+kept in a bounded cache, so most requests are verified without a query.
+Unknown keys are kept in a smaller cache of their own, so that guesses
+cannot push out the keys that are in use.
+Every change to the keys bumps a version in the database, and a worker
+drops its cache when it sees a new version.
+"""
+
+import hmac
+import time
+import logging
+import threading
+from collections import OrderedDict
+from service.model import ApiKey, ApiKeyVersion
+
+logger = logging.getLogger('app')
+
+# Scopes of the key in API_KEY, which may do anything
+ALL_SCOPES = ('write', 'admin')
+
+
+class ApiKeyCache(object):
+    """
+    A bounded cache of verified keys that expire after ttl seconds
+    Keys that are not valid are kept apart in at most miss_size entries
+    """
+
+    def __init__(self, size, ttl, version_check, miss_size):
+        self.size = size
+        self.ttl = ttl
+        self.version_check = version_check
+        self.miss_size = miss_size
+        self.entries = OrderedDict()
+        self.misses = OrderedDict()
+        self.version = None
+        self.next_check = 0
+        self.lock = threading.Lock()
+
+    def check_version(self, now):
+        """ Drops the cache at most every version_check seconds if the keys changed """
+        if now < self.next_check:
+            return
+        version = ApiKeyVersion.current()
+        with self.lock:
+            self.next_check = now + self.version_check
+            if version != self.version:
+                logger.info('API keys changed to version %s, dropping cache', version)
+                self.entries.clear()
+                self.misses.clear()
+                self.version = version
+
+    def scopes(self, key):
+        """ Returns the scopes of a key, None when it is not valid """
+        now = time.monotonic()
+        self.check_version(now)
+        digest = ApiKey.digest(key)
+        with self.lock:
+            for entries in (self.entries, self.misses):
+                entry = entries.get(digest)
+                if entry and entry[0] > now:
+                    entries.move_to_end(digest)
+                    return entry[1]
+        api_key = ApiKey.find_by_key(key)
+        scopes = frozenset(api_key.scopes.split(',')) if api_key else None
+        # a retried bad key costs no query, but every new guess costs one
+        entries, size = (self.entries, self.size) if scopes else (self.misses, self.miss_size)
+        with self.lock:
+            entries.pop(digest, None)
+            entries[digest] = (now + self.ttl, scopes)
+            while len(entries) > size:
+                entries.popitem(last=False)
+        return scopes
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.misses.clear()
+            self.next_check = 0
+
+
+cache = None
+
+
+def init_apikeys(app):
+    """ Sets up the cache of verified keys """
+    global cache
+    cache = ApiKeyCache(app.config['APIKEY_CACHE_SIZE'], app.config['APIKEY_CACHE_TTL'],
+                        app.config['APIKEY_VERSION_CHECK'], app.config['APIKEY_MISS_CACHE_SIZE'])
+    return cache
+
+
+def verify(app, key, scope):
+    """
+    Tells if a key grants a scope
+    Returns None when the key is not valid at all
+    """
+    master = app.config.get('API_KEY')
+    if master and hmac.compare_digest(key.encode('utf-8'), master.encode('utf-8')):
+        return scope in ALL_SCOPES
+    scopes = cache.scopes(key)
+    if scopes is None:
+        return None
+    return scope in scopes
@@ -0,0 +1,156 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Shared cache of listing results
+The rendered results of a listing are cached under its normalized filters and
+the generation of the catalog. Every write bumps the generation, so the
+results cached before it are never read again and expire on their own,
+without tracking which keys a write touched.
+Stores
+------
+MemoryStore - keeps the results in this process, for a single worker
+redis.Redis - keeps the results in Redis, shared by every worker
+"""
+
+import time
+import hashlib
+import logging
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+logger = logging.getLogger('app')
+
+PREFIX = 'products:'
+GENERATION = PREFIX + 'generation'
+
+
+class MemoryStore(object):
+    """ Keeps values in a bounded dictionary, with the calls of a Redis client """
+
+    def __init__(self, size=1024):
+        self.size = size
+        self.values = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, name):
+        with self.lock:
+            item = self.values.get(name)
+            if item is None:
+                return None
+            value, expires = item
+            if expires is not None and expires <= time.monotonic():
+                del self.values[name]
+                return None
+            self.values.move_to_end(name)
+            return value
+
+    def set(self, name, value, ex=None):
+        if isinstance(value, str):
+            value = value.encode('utf-8')
+        with self.lock:
+            self.values[name] = (value, time.monotonic() + ex if ex else None)
+            self.values.move_to_end(name)
+            while len(self.values) > self.size:
+                self.values.popitem(last=False)
+        return True
+
+    def incr(self, name):
+        with self.lock:
+            value, expires = self.values.get(name, (b'0', None))
+            value = int(value) + 1
+            self.values[name] = (str(value).encode('utf-8'), expires)
+            self.values.move_to_end(name)
+        return value
+
+    def flushdb(self):
+        with self.lock:
+            self.values.clear()
+        return True
+
+
+def normalize(params):
+    """ Orders the filters and drops the empty ones, so equal listings share a key """
+    items = sorted((name, value) for name, value in params.items(multi=True) if value)
+    return hashlib.sha1(urlencode(items).encode('utf-8')).hexdigest()
+
+
+class ResultCache(object):
+    """ Caches rendered listings under their filters and the catalog generation """
+
+    def __init__(self, store, ttl):
+        self.store = store
+        self.ttl = ttl
+
+    def generation(self):
+        return int(self.store.get(GENERATION) or 0)
+
+    def fetch(self, params, render):
+        """
+        Returns the cached listing of the filters, or renders and caches it
+        render returns the listing as a string; a failing store only costs a render
+        """
+        try:
+            # read before the query, so that a write committed meanwhile
+            # leaves what is rendered under an old generation
+            key = '{}{}:{}'.format(PREFIX, self.generation(), normalize(params))
+            cached = self.store.get(key)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error('Result cache failed: %s', error)
+            return render()
+        if cached is not None:
+            return cached.decode('utf-8')
+        body = render()
+        try:
+            self.store.set(key, body, ex=self.ttl)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error('Result cache failed: %s', error)
+        return body
+
+    def bump(self):
+        """ Moves every worker to a new generation of the catalog """
+        try:
+            self.store.incr(GENERATION)
+        except Exception as error:  # pylint: disable=broad-except
+            # readers may see the old listings until they expire
+            logger.error('Could not bump the catalog generation: %s', error)
+
+
+cache = None
+
+
+def init_cache(app):
+    """ Sets up the result cache when RESULT_CACHE names a store """
+    global cache
+    storage = app.config['RESULT_CACHE']
+    if storage.startswith('redis'):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RESULT_CACHE {} needs the redis package'.format(storage))
+        store = redis.Redis.from_url(storage)
+    elif storage.startswith('memory'):
+        store = MemoryStore(app.config['RESULT_CACHE_SIZE'])
+    else:
+        cache = None
+        return None
+    cache = ResultCache(store, app.config['RESULT_CACHE_TTL'])
+    return cache
+
+
+def changed(kind):
+    """ Invalidates the cached listings after a write """
+    if cache is not None:
+        cache.bump()
@@ -0,0 +1,260 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Change feed for Products
+Every write to a Product is published as an event that is kept in a bounded
+ring buffer and streamed to clients of GET /products/changes. The events of
+a write are sent with send_many before its transaction commits and
+published with publish_many after, so that an event goes out exactly when
+its write is committed.
+Brokers
+-------
+LocalBroker - appends events straight to the feed of this process
+PostgresBroker - fans events out to every worker through LISTEN/NOTIFY
+"""
+
+import json
+import logging
+import select
+import threading
+import itertools
+from collections import deque
+from sqlalchemy import text
+
+CHANNEL = 'product_changes'
+SEQUENCE = 'product_change_seq'
+# Most bytes of events sent in one NOTIFY, whose payload must stay under 8000
+NOTIFY_SIZE = 7000
+
+# Functions called with the kind of every change of this worker
+listeners = []
+
+# The events held back while a thread runs a transaction that may roll back
+_held = threading.local()
+
+logger = logging.getLogger('app')
+
+
+class ChangeFeed(object):
+    """ A bounded ring buffer of change events that readers can wait on """
+
+    def __init__(self, size):
+        self.events = deque(maxlen=size)
+        self.total = 0
+        self.condition = threading.Condition()
+
+    def append(self, event_id, kind, data):
+        """ Adds an event and wakes up the waiting readers """
+        with self.condition:
+            self.events.append((event_id, kind, data))
+            self.total += 1
+            self.condition.notify_all()
+
+    def cursor(self, last_event_id=None):
+        """
+        Returns the position to read from to resume after last_event_id
+        New readers start at the end. None is returned when last_event_id is
+        not in the buffer, since the events after it may have been lost
+        """
+        with self.condition:
+            if last_event_id is None:
+                return self.total
+            for offset, event in enumerate(reversed(self.events)):
+                if event[0] == last_event_id:
+                    return self.total - offset
+            return None
+
+    def end(self):
+        """ Returns the position after the newest event and its id, '' when there is none """
+        with self.condition:
+            return self.total, self.events[-1][0] if self.events else ''
+
+    def read(self, cursor, timeout=None):
+        """
+        Waits up to timeout seconds for events past the cursor
+        Returns the new cursor and the events read
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.total > cursor, timeout)
+            first = self.total - len(self.events)
+            start = max(cursor, first)
+            return self.total, list(itertools.islice(self.events, start - first, None))
+
+
+class LocalBroker(object):
+    """ Publishes events to the feed of this process only """
+
+    def __init__(self, feed):
+        self.feed = feed
+        self.ids = itertools.count(1)
+
+    def send_many(self, kind, items):
+        pass
+
+    def publish_many(self, kind, items):
+        for data in items:
+            self.feed.append(str(next(self.ids)), kind, data)
+
+    def start(self):
+        pass
+
+
+class PostgresBroker(object):
+    """
+    Publishes events with NOTIFY and feeds them back from a LISTEN thread
+    NOTIFY runs in the transaction of the write, and PostgreSQL delivers it
+    only when that commits. The events of a write are packed into as few
+    notifications as fit, each numbered from a database sequence, and an
+    event is named by the number and its place in the notification so that
+    a client can resume on any worker
+    """
+
+    def __init__(self, feed, engine, session):
+        self.feed = feed
+        self.engine = engine
+        self.session = session
+        self.listener = None
+        self.lock = threading.Lock()
+
+    def send_many(self, kind, items):
+        """ Notifies the events of a write in its transaction, with a single statement """
+        payloads = []
+        chunk = []
+        size = 0
+        for data in items:
+            encoded = json.dumps(data)
+            if chunk and size + len(encoded) > NOTIFY_SIZE:
+                payloads.append(self.payload(kind, chunk))
+                chunk, size = [], 0
+            chunk.append(encoded)
+            size += len(encoded) + 1
+        if chunk:
+            payloads.append(self.payload(kind, chunk))
+        statement = text("SELECT pg_notify(:channel, "
+                         "CAST(nextval('{}') AS TEXT) || ' ' || payload) "
+                         "FROM unnest(CAST(:payloads AS TEXT[])) AS payload".format(SEQUENCE))
+        self.session.execute(statement, {'channel': CHANNEL, 'payloads': payloads})
+
+    @staticmethod
+    def payload(kind, encoded):
+        """ Packs events already encoded as JSON into one notification """
+        return '{{"event": {}, "items": [{}]}}'.format(json.dumps(kind), ', '.join(encoded))
+
+    def publish_many(self, kind, items):
+        # the LISTEN thread appends the events once they are committed
+        pass
+
+    def start(self):
+        """
+        Starts listening, when the worker starts so that its feed holds the
+        events a client may resume from on any worker
+        """
+        with self.lock:
+            if self.listener is None:
+                self.listener = threading.Thread(target=self.listen, name='change-feed')
+                self.listener.daemon = True
+                self.listener.start()
+
+    def listen(self):
+        while True:
+            try:
+                connection = self.engine.raw_connection()
+                dbapi_connection = connection.connection
+                dbapi_connection.autocommit = True
+                dbapi_connection.cursor().execute('LISTEN {}'.format(CHANNEL))
+                logger.info('Listening for product changes')
+                while True:
+                    if select.select([dbapi_connection], [], [], 5) == ([], [], []):
+                        continue
+                    dbapi_connection.poll()
+                    while dbapi_connection.notifies:
+                        notify = dbapi_connection.notifies.pop(0)
+                        number, payload = notify.payload.split(' ', 1)
+                        message = json.loads(payload)
+                        for index, data in enumerate(message['items']):
+                            self.feed.append('{}.{}'.format(number, index),
+                                             message['event'], data)
+            except Exception as error:  # pylint: disable=broad-except
+                logger.error('Product change listener failed: %s', error)
+                threading.Event().wait(1)
+
+
+broker = None
+
+
+def init_changes(app, engine, session):
+    """
+    Sets up the change feed and the broker that fills it
+    session is the session that the writes run in
+    """
+    global broker
+    feed = ChangeFeed(app.config['CHANGE_FEED_SIZE'])
+    if app.config['CHANGE_FEED_BROKER'] == 'postgres':
+        broker = PostgresBroker(feed, engine, session)
+    else:
+        broker = LocalBroker(feed)
+    broker.start()
+    return broker
+
+
+def hold():
+    """ Holds back the events of this thread until release """
+    _held.events = []
+
+
+def held():
+    """ Tells if this thread holds back its events """
+    return getattr(_held, 'events', None) is not None
+
+
+def release():
+    """ Stops holding back events and returns the (kind, items) held """
+    events, _held.events = getattr(_held, 'events', None), None
+    return events or []
+
+
+def send_many(kind, items):
+    """
+    Sends the change events of a write in its transaction, before it commits
+    A failure to send them fails the write
+    """
+    if held():
+        _held.events.append((kind, list(items)))
+        return
+    if broker is not None and items:
+        broker.send_many(kind, items)
+
+
+def publish_many(kind, items):
+    """ Publishes the change events of a write once it is committed """
+    if held() or not items:
+        return
+    notify(kind)
+    if broker is None:
+        return
+    try:
+        broker.publish_many(kind, items)
+    except Exception as error:  # pylint: disable=broad-except
+        # the write has been committed already, losing an event must not fail it
+        logger.error('Could not publish %d %s events: %s', len(items), kind, error)
+
+
+def notify(kind):
+    """ Tells the listeners of this worker about a change """
+    for listener in listeners:
+        try:
+            listener(kind)
+        except Exception as error:  # pylint: disable=broad-except
+            logger.error('Change listener failed on %s: %s', kind, error)
@@ -0,0 +1,197 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Catalog export
+Streams the Products of a listing query as CSV, straight from PostgreSQL
+with COPY TO STDOUT or in chunks of rows elsewhere, or writes them as a
+compressed Parquet file when pyarrow is installed.
+
+Usage:
+------
+python -m service.export --format csv --output catalog.csv category=food
+"""
+
+import io
+import csv
+import sys
+import queue
+import logging
+import argparse
+import threading
+from service.model import Product, db
+
+logger = logging.getLogger('app')
+
+COLUMNS = ('id', 'name', 'category', 'price', 'stock', 'description', 'updated_at')
+FORMATS = ('csv', 'parquet')
+CHUNK_ROWS = 10000
+
+
+def export_query(query):
+    """ Selects the exported columns of the Products of a query, by id """
+    return query.with_entities(
+        Product.id, Product.name, Product.category, Product.price,
+        Product.stock_expression().label('stock'), Product.description,
+        Product.updated_at).order_by(Product.id)
+
+
+def copy_statement(query, dialect=None):
+    """
+    Builds the COPY of a query for PostgreSQL
+    COPY takes no parameters, so the filters are rendered as quoted literals
+    """
+    sql = export_query(query).statement.compile(
+        dialect=dialect or db.engine.dialect, compile_kwargs={'literal_binds': True})
+    return 'COPY ({}) TO STDOUT WITH CSV HEADER'.format(sql)
+
+
+class _Pipe(object):
+    """ A file that COPY writes into and a generator reads from, bounded """
+
+    def __init__(self, size=16):
+        self.chunks = queue.Queue(size)
+        self.cancelled = False
+
+    def write(self, data):
+        while True:
+            if self.cancelled:
+                raise IOError('export cancelled')
+            try:
+                self.chunks.put(data, timeout=1)
+                return len(data)
+            except queue.Full:
+                continue
+
+
+def stream_copy(query):
+    """ Streams the CSV that PostgreSQL writes for COPY TO STDOUT """
+    statement = copy_statement(query)
+    pipe = _Pipe()
+    done = object()
+    failure = []
+
+    def run():
+        connection = db.engine.raw_connection()
+        try:
+            connection.cursor().copy_expert(statement, pipe)
+        except Exception as error:  # pylint: disable=broad-except
+            failure.append(error)
+        finally:
+            connection.close()
+            if not pipe.cancelled:
+                pipe.chunks.put(done)
+
+    thread = threading.Thread(target=run, name='catalog-export')
+    thread.daemon = True
+    thread.start()
+    try:
+        while True:
+            chunk = pipe.chunks.get()
+            if chunk is done:
+                break
+            yield chunk
+    finally:
+        pipe.cancelled = True
+    if failure:
+        raise failure[0]
+
+
+def stream_rows(query, chunk_rows=CHUNK_ROWS):
+    """ Streams the CSV of a query written from rows fetched in chunks """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(COLUMNS)
+    result = db.session.execute(export_query(query).statement.execution_options(
+        stream_results=True))
+    while True:
+        rows = result.fetchmany(chunk_rows)
+        if not rows:
+            break
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.getvalue():
+        yield buffer.getvalue()
+
+
+def stream_csv(query):
+    """ Streams the Products of a query as CSV with a header """
+    logger.info('Exporting products as CSV')
+    if db.engine.dialect.name == 'postgresql':
+        return stream_copy(query)
+    return stream_rows(query)
+
+
+def write_parquet(query, output, chunk_rows=CHUNK_ROWS):
+    """
+    Writes the Products of a query to a zstd compressed Parquet file
+    Raises RuntimeError when pyarrow is not installed
+    """
+    try:
+        import pyarrow
+        import pyarrow.parquet as parquet
+    except ImportError:
+        raise RuntimeError('The parquet export needs the pyarrow package')
+    logger.info('Exporting products as Parquet')
+    schema = pyarrow.schema([('id', pyarrow.int64()), ('name', pyarrow.string()),
+                             ('category', pyarrow.string()),
+                             ('price', pyarrow.decimal128(18, 2)),
+                             ('stock', pyarrow.int64()), ('description', pyarrow.string()),
+                             ('updated_at', pyarrow.timestamp('us'))])
+    result = db.session.execute(export_query(query).statement.execution_options(
+        stream_results=True))
+    writer = parquet.ParquetWriter(output, schema, compression='zstd')
+    try:
+        while True:
+            rows = result.fetchmany(chunk_rows)
+            if not rows:
+                break
+            columns = list(zip(*rows))
+            writer.write_table(pyarrow.Table.from_arrays(
+                [pyarrow.array(column, type=field.type)
+                 for column, field in zip(columns, schema)], schema=schema))
+    finally:
+        writer.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Export the Product catalog')
+    parser.add_argument('filters', nargs='*', metavar='name=value',
+                        help='Filters of the listing, such as category=food')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--output', required=True, help='The file to write')
+    args = parser.parse_args(argv)
+    from service import app
+    from service.service import init_db, product_query
+    init_db()
+    query_string = dict(item.split('=', 1) for item in args.filters)
+    with app.test_request_context(query_string=query_string):
+        query = product_query()
+        if args.format == 'parquet':
+            try:
+                write_parquet(query, args.output)
+            except RuntimeError as error:
+                parser.error(str(error))
+            return 0
+        # the service logs to stdout, so the catalog always goes to a file
+        with open(args.output, 'wb') as output:
+            for chunk in stream_csv(query):
+                output.write(chunk if isinstance(chunk, bytes) else chunk.encode('utf-8'))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -23,20 +23,201 @@ Attributes:
 name (string) - the name of the product
 stock (integer) - the amound of the product in stock
 price (numeric)) - the price of the product
+price_cents (bigint) - the price of the product in cents, written with every price
 description (string) - the description of the product
 category (string) - the category the product belongs to (i.e. apparel, Electric appliance)
+stock_shards (integer) - the number of stock counter slots, 0 when stock is not sharded
+updated_at (datetime) - when the product was last created or changed
+
+Tombstone - A record that a Product was deleted, kept for delta syncs
+Attributes:
+-----------
+product_id (integer) - the id of the deleted product
+deleted_at (datetime) - when the product was deleted
+
+CategoryStats - The running totals of the Products in a category
+Attributes:
+-----------
+category (string) - the category, an empty string for Products without one
+count (integer) - the number of products in the category
+stock (integer) - the total stock of the products
+stock_value (numeric) - the total of stock times price of the products
+price_total (numeric) - the total of the prices of the products
+min_price (numeric) - the lowest price of the products
+max_price (numeric) - the highest price of the products
+
+StockShard - One slot of a sharded stock counter
+Attributes:
+-----------
+product_id (integer) - the product the slot belongs to
+slot (integer) - the index of the slot
+stock (integer) - the amount of stock held by the slot
+
+IdempotencyKey - A stored response to a request carrying an Idempotency-Key
+Attributes:
+-----------
+key (string) - the Idempotency-Key sent by the client
+fingerprint (string) - a digest of the method, path and body of the request
+status (integer) - the status code of the response, empty while in progress
+headers (text) - the JSON encoded headers of the response
+body (binary) - the body of the response
+created (datetime) - when the request was first seen
+
+ApiKey - A key that clients send in the X-Api-Key header
+Attributes:
+-----------
+name (string) - who the key was issued to
+key_hash (string) - the SHA-256 digest of the key, the key itself is not stored
+scopes (string) - the comma separated scopes the key grants (i.e. write, admin)
+revoked (boolean) - whether the key has been revoked
+created (datetime) - when the key was issued
+
+ApiKeyVersion - A counter bumped by every change to the API keys
 """
 
+import math
+import uuid
+import hashlib
 import logging
+import random
+from collections import OrderedDict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from decimal import Decimal, Context, ROUND_FLOOR, ROUND_HALF_UP
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import event, any_
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import DBAPIError, IntegrityError
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.orm import validates
+from sqlalchemy.orm.attributes import flag_modified
 import flask
+from service import changes
 
 # Create the SQLAlchemy object to be initialized later in init_db()
 db = SQLAlchemy()
 
+# Ids of the events published to the change feed through Postgres
+change_sequence = db.Sequence(changes.SEQUENCE, metadata=db.metadata)
+
+# The smallest unit of a price
+CENT = Decimal('0.01')
+
+
+class SQLiteDecimal(TypeDecorator):
+    """
+    Numeric column of SQLite, which has no decimal type
+    Values are stored as REAL and read back as a Decimal rounded to the
+    scale of the column. A double holds about 15 significant digits, so
+    values with cents are only exact below about 10**13, and sums such as
+    the stock value of a category can lose cents sooner; PostgreSQL keeps
+    every digit of the column
+    """
+    impl = db.Float
+
+    def __init__(self, scale):
+        super(SQLiteDecimal, self).__init__()
+        self.format = '{:.%df}' % scale
+
+    def process_bind_param(self, value, dialect):
+        return None if value is None else float(value)
+
+    def process_result_value(self, value, dialect):
+        return None if value is None else Decimal(self.format.format(value))
+
+
+def numeric(precision, scale):
+    """ A Numeric column type that also works on SQLite """
+    return db.Numeric(precision, scale).with_variant(SQLiteDecimal(scale), 'sqlite')
+
+
+def to_cents(price, rounding=ROUND_HALF_UP):
+    """
+    Converts a price to whole cents, rounded half up like a price column
+    Raises DataValidationError when the price is not a number
+    """
+    try:
+        return int(Decimal(str(price)).quantize(
+            CENT, rounding=rounding, context=MONEY).scaleb(2, context=MONEY))
+    except ArithmeticError:
+        raise DataValidationError('Invalid product: price must be a number')
+
+
+def sqlite_shims(engine):
+    """
+    Lets SQLAlchemy emit BEGIN on SQLite instead of the pysqlite driver,
+    which otherwise commits before a SAVEPOINT and breaks begin_nested
+    """
+    if engine.dialect.name != 'sqlite' or getattr(engine, 'sqlite_shims', False):
+        return
+    engine.sqlite_shims = True
+
+    @event.listens_for(engine, 'connect')
+    def connect(dbapi_connection, connection_record):  # pylint: disable=unused-variable
+        dbapi_connection.isolation_level = None
+
+    @event.listens_for(engine, 'begin')
+    def begin(connection):  # pylint: disable=unused-variable
+        connection.execute('BEGIN')
+
+
+def commit_changes(kind, items):
+    """
+    Commits the session with the change events of its writes
+    The events are sent in the transaction and published once it commits
+    """
+    changes.send_many(kind, items)
+    db.session.commit()
+    changes.publish_many(kind, items)
+
+
+@contextmanager
+def single_transaction():
+    """
+    Runs a block of writes in one database transaction
+    The commits of the block only release a SAVEPOINT, so its work is
+    committed when the block ends and rolled back when it raises, and the
+    change events are published only once the work is committed
+    """
+    session = db.session()
+    session.connection()
+    savepoint = session.begin_nested()
+    parent = savepoint.parent
+
+    def restart(session, transaction):
+        if transaction.nested and transaction.parent is parent and session.is_active:
+            session.begin_nested()
+
+    event.listen(session, 'after_transaction_end', restart)
+    changes.hold()
+    try:
+        try:
+            yield
+        finally:
+            event.remove(session, 'after_transaction_end', restart)
+        while parent.is_active and session.transaction is not parent:
+            session.commit()
+        events = changes.release()
+        for kind, items in events:
+            changes.send_many(kind, items)
+        session.commit()
+    except BaseException:
+        while parent.is_active and session.transaction is not parent:
+            session.rollback()
+        session.rollback()
+        changes.release()
+        raise
+    for kind, items in events:
+        changes.publish_many(kind, items)
+
+
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
-    pass
+
+    def __init__(self, message, errors=None):
+        super(DataValidationError, self).__init__(message)
+        # the errors of every item of a batch that was not valid
+        self.errors = errors
 
 class Product(db.Model):
     """
@@ -45,43 +226,484 @@ class Product(db.Model):
 
     logger = logging.getLogger('app')
     app = None
+    __table_args__ = (db.Index('ix_product_updated_at_id', 'updated_at', 'id'),
+                      db.Index('ix_product_name_id', 'name', 'id'),
+                      db.Index('ix_product_price_id', 'price', 'id'),
+                      db.Index('ix_product_category_name_id', 'category', 'name', 'id'),
+                      db.Index('ix_product_category_price_id', 'category', 'price', 'id'),
+                      db.Index('ix_product_price_cents_id', 'price_cents', 'id'),
+                      db.Index('ix_product_category_price_cents_id',
+                               'category', 'price_cents', 'id'))
+    # Fields a client may change with a partial update
+    PATCHABLE = ('name', 'stock', 'price', 'description', 'category')
+    # Columns a listing may be sorted by, each led by the columns it must be
+    # filtered on by equality; every sort has an index of these columns and
+    # id, which is read forwards or backwards
+    SORTS = (('id',), ('name',), ('price',), ('updated_at',),
+             ('category', 'name'), ('category', 'price'))
+    # Prices are read, filtered and added up in cents rather than as decimals
+    price_in_cents = False
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50))
     stock = db.Column(db.Integer)
-    price = db.Column(db.Numeric(18,2))
+    price = db.Column(numeric(18, 2))
+    price_cents = db.Column(db.BigInteger)
     description = db.Column(db.String(255))
-    category = db.Column(db.String(50))
+    category = db.Column(db.String(50), index=True)
+    stock_shards = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, nullable=False,
+                           default=datetime.utcnow, onupdate=datetime.utcnow)
+    shards = db.relationship('StockShard', order_by='StockShard.slot',
+                             cascade='all, delete-orphan')
 
     def save(self):
         """
         Saves a Product to the data store
         """
         Product.logger.info('Saving %s', self.name)
+        kind = 'update' if self.id else 'create'
+        stored = self._stored_totals() if CategoryStats.enabled and self.id else None
         if not self.id:
             db.session.add(self)
-        db.session.commit()
+        if self.stock_shards and db.inspect(self).attrs.stock.history.has_changes():
+            self._spread_stock()
+        if CategoryStats.enabled:
+            db.session.flush()
+            if stored:
+                CategoryStats.remove(*stored)
+            CategoryStats.add(self.category, self.price, self.available_stock())
+        db.session.flush()
+        commit_changes(kind, [self.serialize()])
 
     def delete(self):
         Product.logger.info("Deleting %s", self.name)
+        product_id = self.id
+        stored = (self.category, self.price, self.available_stock())
         db.session.delete(self)
-        db.session.commit()
+        db.session.merge(Tombstone(product_id=product_id, deleted_at=datetime.utcnow()))
+        if CategoryStats.enabled:
+            db.session.flush()
+            CategoryStats.remove(*stored)
+        commit_changes('delete', [{'id': product_id}])
 
     @classmethod
     def delete_all(cls):
         Product.logger.info("Deleting all products")
+        db.session.query(StockShard).delete()
+        Tombstone.query.filter(Tombstone.product_id.in_(db.session.query(cls.id))).delete(
+            synchronize_session=False)
+        db.session.execute(Tombstone.__table__.insert().from_select(
+            ['product_id', 'deleted_at'],
+            db.session.query(cls.id, db.literal(datetime.utcnow()))))
         db.session.query(cls).delete()
-        db.session.commit()
+        db.session.query(CategoryStats).delete()
+        commit_changes('reset', [{}])
+
+    @classmethod
+    def delete_matching(cls, query, batch_size):
+        """
+        Deletes the Products of a query without loading them
+        Rows are deleted by id in batches of batch_size, each in its own
+        transaction, so that locks are held briefly
+        Returns the number of Products deleted
+        """
+        cls.logger.info('Deleting matching products in batches of %d', batch_size)
+        stock = cls.stock_expression()
+        deleted = 0
+        while True:
+            batch = query.with_entities(cls.id, cls.category, cls.price, stock).order_by(
+                cls.id).limit(batch_size).all()
+            if not batch:
+                break
+            ids = [row[0] for row in batch]
+            StockShard.query.filter(StockShard.product_id.in_(ids)).delete(
+                synchronize_session=False)
+            Tombstone.query.filter(Tombstone.product_id.in_(ids)).delete(
+                synchronize_session=False)
+            now = datetime.utcnow()
+            db.session.execute(Tombstone.__table__.insert(),
+                               [{'product_id': product_id, 'deleted_at': now}
+                                for product_id in ids])
+            cls.query.filter(cls.id.in_(ids)).delete(synchronize_session=False)
+            if CategoryStats.enabled:
+                for _, category, price, product_stock in batch:
+                    CategoryStats.remove(category, price, product_stock)
+            commit_changes('delete', [{'id': product_id} for product_id in ids])
+            deleted += len(ids)
+            if len(ids) < batch_size:
+                break
+        db.session.expire_all()
+        return deleted
+
+    @classmethod
+    def fill_price_cents(cls, batch_size):
+        """
+        Writes price_cents for the Products whose cents do not match their price
+        These are the Products saved before the column existed or changed
+        by a service that did not write it yet. Rows are updated by id in
+        batches of batch_size, each in its own transaction, so that the
+        service keeps running while they are filled
+        Returns the number of Products filled
+        """
+        cls.logger.info('Filling prices in cents in batches of %d', batch_size)
+        table = cls.__table__
+        # only the price that was read is converted, a price written meanwhile
+        # is left for its writer or the next run; the timestamp is kept too,
+        # since the Product did not change
+        update = table.update().where(db.and_(
+            table.c.id == db.bindparam('product_id'),
+            table.c.price == db.bindparam('read_price'))).values(
+                price_cents=db.bindparam('cents'), updated_at=table.c.updated_at)
+        clear = table.update().where(db.and_(
+            table.c.id == db.bindparam('product_id'), table.c.price.is_(None))).values(
+                price_cents=None, updated_at=table.c.updated_at)
+        filled = 0
+        last_id = 0
+        while True:
+            batch = db.session.query(cls.id, cls.price).filter(
+                cls.id > last_id, cls.stale_cents()).order_by(cls.id).limit(batch_size).all()
+            if not batch:
+                break
+            priced = [{'product_id': product_id, 'read_price': price, 'cents': to_cents(price)}
+                      for product_id, price in batch if price is not None]
+            unpriced = [{'product_id': product_id} for product_id, price in batch
+                        if price is None]
+            if priced:
+                db.session.execute(update, priced)
+            if unpriced:
+                db.session.execute(clear, unpriced)
+            db.session.commit()
+            filled += len(batch)
+            last_id = batch[-1][0]
+            if len(batch) < batch_size:
+                break
+        return filled
+
+    @classmethod
+    def stale_cents(cls):
+        """ SQL condition of the Products whose price_cents do not match their price """
+        return db.or_(
+            db.and_(cls.price.isnot(None),
+                    db.or_(cls.price_cents.is_(None),
+                           cls.price_cents != db.func.round(cls.price * 100))),
+            db.and_(cls.price.is_(None), cls.price_cents.isnot(None)))
+
+    @classmethod
+    def add_cents_column(cls):
+        """
+        Adds the price_cents column to a product table created without it
+        create_all only creates missing tables, and every query of a Product
+        reads the column. Returns True when it was added
+        """
+        engine = db.engine
+        if 'price_cents' in {column['name'] for column in
+                             db.inspect(engine).get_columns(cls.__tablename__)}:
+            return False
+        cls.logger.info('Adding column price_cents')
+        try:
+            # a nullable column without a default does not rewrite the table
+            with engine.begin() as connection:
+                connection.execute('ALTER TABLE {} ADD COLUMN price_cents BIGINT'.format(
+                    cls.__tablename__))
+        except DBAPIError:
+            # another worker added it first
+            if 'price_cents' not in {column['name'] for column in
+                                     db.inspect(engine).get_columns(cls.__tablename__)}:
+                raise
+            return False
+        return True
+
+    def available_stock(self):
+        """ Returns the stock of a Product, summing the slots when sharded """
+        if self.stock_shards:
+            return sum(shard.stock for shard in self.shards)
+        return self.stock
+
+    def _stored_totals(self):
+        """ Reads the category, price and stock of a Product as last saved """
+        with db.session.no_autoflush:
+            stored = db.session.query(Product.category, Product.price, Product.stock,
+                                      Product.stock_shards).filter(
+                                          Product.id == self.id).first()
+            if not stored:
+                return None
+            category, price, stock, stock_shards = stored
+            if stock_shards:
+                stock = db.session.query(db.func.sum(StockShard.stock)).filter(
+                    StockShard.product_id == self.id).scalar()
+        return category, price, stock or 0
+
+    def shard_stock(self, slots):
+        """
+        Splits the stock of a Product across a number of counter slots
+        Buyers of a sharded Product only lock the slot they draw from, so
+        a hot Product can be bought concurrently. A value of 0 or 1 folds
+        the slots back into the stock column.
+        """
+        Product.logger.info('Sharding stock of %s across %d slots', self.name, slots)
+        self.stock = self.available_stock()
+        self.stock_shards = slots if slots > 1 else 0
+        if self.stock_shards:
+            self._spread_stock()
+        else:
+            self.shards = []
+        self.save()
+
+    def _spread_stock(self):
+        """ Distributes the stock column evenly across the counter slots """
+        share, remainder = divmod(self.stock or 0, self.stock_shards)
+        existing = {shard.slot: shard for shard in self.shards}
+        shards = []
+        for slot in range(self.stock_shards):
+            shard = existing.get(slot) or StockShard(slot=slot)
+            shard.stock = share + (1 if slot < remainder else 0)
+            shards.append(shard)
+        self.shards = shards
+
+    def buy(self):
+        """
+        Takes one item out of stock
+        Returns False when the Product has been sold out
+        """
+        if not self.stock_shards:
+            if self.stock == 0:
+                return False
+            self.stock = self.stock - 1
+            if CategoryStats.enabled:
+                CategoryStats.take_stock(self.category, self.price)
+            commit_changes('stock', [{'id': self.id, 'stock': self.stock}])
+            return True
+        # Start at a random slot and fall back to the others when it is empty
+        first = random.randrange(self.stock_shards)
+        for offset in range(self.stock_shards):
+            slot = (first + offset) % self.stock_shards
+            updated = StockShard.query.filter(
+                StockShard.product_id == self.id,
+                StockShard.slot == slot,
+                StockShard.stock > 0).update(
+                    {StockShard.stock: StockShard.stock - 1},
+                    synchronize_session=False)
+            if updated:
+                if CategoryStats.enabled:
+                    CategoryStats.take_stock(self.category, self.price)
+                # the slots loaded with the Product predate the update
+                stock = db.session.query(db.func.sum(StockShard.stock)).filter(
+                    StockShard.product_id == self.id).scalar()
+                commit_changes('stock', [{'id': self.id, 'stock': stock}])
+                return True
+        db.session.rollback()
+        return False
+
+    @validates('price')
+    def _write_cents(self, key, price):
+        """ Keeps price_cents in step with every price written through a Product """
+        self.price_cents = None if price is None else to_cents(price)
+        return price
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
         return {"id": self.id,
                 "name": self.name,
-                "stock": self.stock,
-                "price": float(self.price),
+                "stock": self.available_stock(),
+                # dividing whole cents gives the float nearest the exact
+                # decimal, the same that float(self.price) would
+                "price": self.price_cents / 100 if self.price_in_cents else float(self.price),
                 "description": self.description,
-                "category": self.category}
+                "category": self.category,
+                "updated_at": self.updated_at.isoformat() if self.updated_at else None}
+
+    @classmethod
+    def field_columns(cls):
+        """ The SQL expression of every field that serialize returns """
+        return OrderedDict([('id', cls.id), ('name', cls.name),
+                            ('stock', cls.stock_expression()), ('price', cls.price_column()),
+                            ('description', cls.description), ('category', cls.category),
+                            ('updated_at', cls.updated_at)])
+
+    @classmethod
+    def select_fields(cls, query, fields):
+        """
+        Reads only the columns of some fields of the Products of a query
+        Returns dictionaries like serialize with just those fields
+        """
+        columns = cls.field_columns()
+        results = []
+        for row in query.with_entities(*(columns[name].label(name) for name in fields)):
+            item = row._asdict()
+            if item.get('price') is not None:
+                item['price'] = (item['price'] / 100 if cls.price_in_cents
+                                 else float(item['price']))
+            if item.get('updated_at') is not None:
+                item['updated_at'] = item['updated_at'].isoformat()
+            results.append(item)
+        return results
+
+    @classmethod
+    def serialize_all(cls, query, fields=None):
+        """
+        Serializes the Products of a query, with only some fields when given
+        Prices kept in cents are read as plain columns, without building a
+        Product and a Decimal for every row
+        """
+        if fields or cls.price_in_cents:
+            return cls.select_fields(query, fields or list(cls.field_columns()))
+        return [product.serialize() for product in query]
+
+    @classmethod
+    def price_column(cls):
+        """ The column that prices are read, compared and added up on """
+        return cls.price_cents if cls.price_in_cents else cls.price
+
+    @classmethod
+    def price_value(cls, price):
+        """
+        Converts a price to compare with price_column
+        Cents are rounded down, so that (low, high] ranges keep the same prices
+        """
+        if price is None or not cls.price_in_cents:
+            return price
+        return to_cents(price, ROUND_FLOOR)
+
+    @classmethod
+    def column_price(cls, value):
+        """ Converts a value or total of price_column to a decimal price """
+        if value is None or not cls.price_in_cents:
+            return value
+        return Decimal(value).scaleb(-2, context=MONEY)
+
+    @staticmethod
+    def column_values(values):
+        """ Adds the price in cents to the values of an update that sets the price """
+        if 'price' not in values:
+            return values
+        price = values['price']
+        return dict(values, price_cents=None if price is None else to_cents(price))
+
+    @classmethod
+    def partial(cls, data):
+        """
+        Validates the fields of a partial update
+        Returns the column values to write
+        """
+        if not isinstance(data, dict):
+            raise DataValidationError('Invalid product: body of request contained '
+                                      'bad or no data')
+        unknown = set(data) - set(cls.PATCHABLE)
+        if unknown:
+            raise DataValidationError(
+                'Invalid product: cannot update ' + ', '.join(sorted(unknown)))
+        if data.get('name', None) == '' or data.get('category', None) == '':
+            raise DataValidationError('Field cannot be empty string')
+        return dict(data)
+
+    @classmethod
+    def patch(cls, product_id, data):
+        """
+        Updates only the given fields of a Product
+        The write is a single UPDATE ... RETURNING, unless the Product has
+        sharded stock or category stats are kept, which need the stored row
+        Returns the serialized Product or None when it was not found
+        """
+        values = cls.partial(data)
+        cls.logger.info('Patching %s of product %s', sorted(values), product_id)
+        if not values:
+            product = cls.find(product_id)
+            return product.serialize() if product else None
+        table = cls.__table__
+        update = table.update().where(db.and_(
+            table.c.id == product_id, table.c.stock_shards == 0)).values(
+                **cls.column_values(values))
+        row = None
+        if not CategoryStats.enabled:
+            if db.session.get_bind().dialect.implicit_returning:
+                row = db.session.execute(update.returning(*table.c)).first()
+            elif db.session.execute(update).rowcount:
+                row = db.session.execute(table.select().where(table.c.id == product_id)).first()
+        if row is None:
+            # missing, sharded or counted in category stats
+            db.session.rollback()
+            product = cls.find(product_id)
+            if not product:
+                return None
+            for name, value in values.items():
+                setattr(product, name, value)
+            if 'stock' in values and product.stock_shards:
+                flag_modified(product, 'stock')
+            product.save()
+            return product.serialize()
+        product = cls(**dict(row)).serialize()
+        commit_changes('update', [product])
+        return product
+
+    @classmethod
+    def patch_many(cls, items):
+        """
+        Updates the given fields of many Products in one transaction
+        Updates that set the same fields are sent together with executemany,
+        and their change events carry the fields written, without reading
+        the rows back
+        Returns the ids that were updated and the ids that were not found
+        """
+        updates = {}
+        for item in items:
+            if not isinstance(item, dict) or not isinstance(item.get('id'), int):
+                raise DataValidationError('Invalid product: every update needs an id')
+            if item['id'] in updates:
+                raise DataValidationError(
+                    'Invalid products: product {} is updated twice'.format(item['id']))
+            values = cls.partial({name: value for name, value in item.items() if name != 'id'})
+            updates[item['id']] = values
+        cls.logger.info('Patching %d products', len(updates))
+        stored = dict(db.session.query(cls.id, cls.stock_shards).filter(
+            cls.id.in_(list(updates))).all()) if updates else {}
+        missing = [product_id for product_id in updates if product_id not in stored]
+        # every row is stamped with the same time, so that its event can tell it
+        now = datetime.utcnow()
+        batches = {}
+        singles = []
+        events = []
+        for product_id, values in updates.items():
+            if product_id not in stored or not values:
+                continue
+            columns = dict(cls.column_values(values), updated_at=now)
+            events.append(cls.written(product_id, columns))
+            if CategoryStats.enabled or ('stock' in values and stored[product_id]):
+                singles.append(product_id)
+            else:
+                batches.setdefault(tuple(sorted(columns)), []).append(
+                    dict(columns, product_id=product_id))
+        table = cls.__table__
+        for names, params in batches.items():
+            update = table.update().where(table.c.id == db.bindparam('product_id')).values(
+                {name: db.bindparam(name) for name in names})
+            db.session.execute(update, params)
+        for product_id in singles:
+            product = cls.query.get(product_id)
+            stored_totals = product._stored_totals() if CategoryStats.enabled else None
+            for name, value in updates[product_id].items():
+                setattr(product, name, value)
+            product.updated_at = now
+            if 'stock' in updates[product_id] and product.stock_shards:
+                product._spread_stock()
+            if stored_totals:
+                db.session.flush()
+                CategoryStats.remove(*stored_totals)
+                CategoryStats.add(product.category, product.price, product.available_stock())
+        updated = [product_id for product_id in updates if product_id in stored]
+        commit_changes('update', events)
+        return updated, missing
+
+    @classmethod
+    def written(cls, product_id, columns):
+        """ Serializes the fields that an update wrote, as serialize would """
+        data = {name: value for name, value in columns.items() if name in cls.PATCHABLE}
+        if 'price' in data:
+            price_cents = columns['price_cents']
+            data['price'] = None if price_cents is None else price_cents / 100
+        data.update(id=product_id, updated_at=columns['updated_at'].isoformat())
+        return data
 
     def deserialize(self, data):
         """
@@ -94,6 +716,9 @@ class Product(db.Model):
                 raise DataValidationError('Field cannot be empty string')
             self.name = data['name']
             self.stock = data['stock']
+            if self.stock_shards:
+                # always respread the stock a client sets on a sharded Product
+                flag_modified(self, 'stock')
             self.price = data['price']
             self.description = data['description']
             self.category = data['category']
@@ -115,7 +740,18 @@ class Product(db.Model):
         if flask.has_request_context() == False:
             app.app_context().push()
         with app.app_context():
+            sqlite_shims(db.engine)
             db.create_all()  # make our sqlalchemy tables
+            changes.init_changes(app, db.engine, db.session)
+            cls.add_cents_column()
+            cls.price_in_cents = False
+            if app.config['PRICE_IN_CENTS']:
+                if db.session.query(cls.id).filter(cls.stale_cents()).first():
+                    cls.logger.warning('PRICE_IN_CENTS is set but some prices have no '
+                                       'matching cents, run python -m service.prices')
+                else:
+                    cls.price_in_cents = True
+            CategoryStats.init_summary(app.config['STATS_SUMMARY'])
 
     @classmethod
     def find(cls, product_id):
@@ -123,6 +759,28 @@ class Product(db.Model):
         cls.logger.info('Processing lookup for id %s ...', product_id)
         return cls.query.get(product_id)
 
+    @classmethod
+    def find_many(cls, product_ids):
+        """
+        Finds the Products with the ids in one query
+        Returns them in the order of the ids, without the ids not found
+        """
+        cls.logger.info('Processing lookup for %d ids ...', len(product_ids))
+        if not product_ids:
+            return []
+        found = {product.id: product
+                 for product in cls.query.filter(cls.ids_condition(product_ids))}
+        return [found[product_id] for product_id in product_ids if product_id in found]
+
+    @classmethod
+    def ids_condition(cls, product_ids):
+        """ SQL condition that matches the Products of a list of ids """
+        if db.session.get_bind().dialect.name == 'postgresql':
+            # one array parameter keeps the statement the same for any number of ids
+            return cls.id == any_(db.bindparam('ids', list(product_ids),
+                                               type_=postgresql.ARRAY(db.Integer)))
+        return cls.id.in_(product_ids)
+
     @classmethod
     def find_by_category(cls, category):
         cls.logger.info('Processing category query for %s ...', category)
@@ -134,11 +792,561 @@ class Product(db.Model):
         return cls.query.filter(cls.name == name)
 
     @classmethod
-    def find_by_price(cls, low, high):
-        cls.logger.info('Processing price query as range (%d %d] ...', low, high)
-        return cls.query.filter(db.and_(cls.price > low, cls.price <= high))
+    def find_by_price(cls, low=None, high=None):
+        cls.logger.info('Processing price query as range (%s %s] ...', low, high)
+        return cls.query.filter(*cls.price_conditions(low, high))
+
+    @classmethod
+    def price_conditions(cls, low=None, high=None):
+        """ SQL conditions of prices in the range (low, high], either end may be None """
+        price = cls.price_column()
+        conditions = []
+        if low is not None:
+            conditions.append(price > cls.price_value(low))
+        if high is not None:
+            conditions.append(price <= cls.price_value(high))
+        return conditions
+
+    @classmethod
+    def find_changed(cls, since, after_id, until, limit):
+        """
+        Finds the Products changed and deleted in [since, until)
+        Changes are ordered by (updated_at, id) and start after the row
+        (since, after_id), so that a sync can page through them. Returns a
+        list of (timestamp, id, product) where product is None for deletions
+        """
+        cls.logger.info('Processing changes since %s after id %s ...', since, after_id)
+        products = cls.query.filter(
+            db.or_(cls.updated_at > since,
+                   db.and_(cls.updated_at == since, cls.id > after_id)),
+            cls.updated_at < until).order_by(cls.updated_at, cls.id).limit(limit)
+        tombstones = Tombstone.query.filter(
+            db.or_(Tombstone.deleted_at > since,
+                   db.and_(Tombstone.deleted_at == since, Tombstone.product_id > after_id)),
+            Tombstone.deleted_at < until).order_by(
+                Tombstone.deleted_at, Tombstone.product_id).limit(limit)
+        found = [(product.updated_at, product.id, product) for product in products]
+        found += [(tombstone.deleted_at, tombstone.product_id, None) for tombstone in tombstones]
+        found.sort(key=lambda change: change[:2])
+        return found[:limit]
+
+    @classmethod
+    def last_changed(cls):
+        """ When a Product was last created, changed or deleted, None when never """
+        times = (db.session.query(db.func.max(cls.updated_at)).scalar(),
+                 db.session.query(db.func.max(Tombstone.deleted_at)).scalar())
+        return max((stamp for stamp in times if stamp is not None), default=None)
+
+    @classmethod
+    def check_sort(cls, keys, equal=()):
+        """
+        Refuses a sort that no index can serve
+        keys are (column, descending) pairs and equal the columns the query
+        is filtered on by equality, which an index may lead with
+        """
+        columns = tuple(name for name, _ in keys)
+        if columns[-1:] == ('id',) and len(columns) > 1:
+            columns = columns[:-1]
+        if len({descending for _, descending in keys}) > 1:
+            raise DataValidationError(
+                'Invalid sort: every column must be sorted in the same direction')
+        if columns not in cls.SORTS and tuple(equal) + columns not in cls.SORTS:
+            raise DataValidationError('Invalid sort: {} has no index, sort by one of {}'.format(
+                ','.join(columns), '; '.join(','.join(sort) for sort in cls.SORTS)))
+
+    @classmethod
+    def sorted_page(cls, query, keys, after=None, limit=None):
+        """
+        Sorts a query of Products by checked keys and id, and pages it
+        after holds the values of the sort columns and id of the row to start
+        after. Rows with a NULL sort column are left out, since databases
+        disagree on where NULL sorts
+        """
+        names = [name for name, _ in keys if name != 'id'] + ['id']
+        columns = [cls.price_column() if name == 'price' else getattr(cls, name)
+                   for name in names]
+        descending = keys[0][1]
+        for column in columns:
+            if column.nullable:
+                query = query.filter(column.isnot(None))
+        if after is not None:
+            try:
+                if len(after) != len(names):
+                    raise ValueError('cursor does not match the sort')
+                values = [cls.sort_value(name, value) for name, value in zip(names, after)]
+            except (ValueError, TypeError, ArithmeticError):
+                raise DataValidationError('Invalid sort: the cursor does not match the sort')
+            beyond = [column < value if descending else column > value
+                      for column, value in zip(columns, values)]
+            query = query.filter(db.or_(*(
+                db.and_(*([column == value for column, value in
+                           zip(columns[:index], values[:index])] + [beyond[index]]))
+                for index in range(len(columns)))))
+        query = query.order_by(*(column.desc() if descending else column for column in columns))
+        return query.limit(limit) if limit else query
+
+    @classmethod
+    def sort_value(cls, name, value):
+        """
+        Converts a serialized value of a sort column back to its column type
+        Raises DataValidationError when the value has the wrong type
+        """
+        if name == 'id':
+            valid = isinstance(value, int) and not isinstance(value, bool)
+        elif name == 'price':
+            valid = isinstance(value, (int, float, str)) and not isinstance(value, bool)
+        else:
+            valid = isinstance(value, str)
+        if not valid:
+            raise DataValidationError('Invalid sort: the cursor holds a bad {}'.format(name))
+        if name == 'price':
+            return cls.price_value(Decimal(str(value)))
+        if name == 'updated_at':
+            return datetime.strptime(value, '%Y-%m-%dT%H:%M:%S.%f' if '.' in value
+                                     else '%Y-%m-%dT%H:%M:%S')
+        return value
+
+    @classmethod
+    def stock_expression(cls):
+        """ SQL expression of the stock of a Product, summing the slots when sharded """
+        shard_stock = db.select([db.func.coalesce(db.func.sum(StockShard.stock), 0)]).where(
+            StockShard.product_id == cls.id).as_scalar()
+        return db.case([(cls.stock_shards > 0, shard_stock)],
+                       else_=db.func.coalesce(cls.stock, 0))
+
+    @classmethod
+    def category_totals(cls):
+        """
+        Aggregates the Products of every category in one grouped query
+        Returns rows of (category, count, stock, stock_value, price_total,
+        min_price, max_price)
+        """
+        cls.logger.info('Processing category totals')
+        stock = cls.stock_expression()
+        price = cls.price_column()
+        totals = db.session.query(
+            cls.category, db.func.count(cls.id), db.func.sum(stock),
+            db.func.sum(stock * price), db.func.sum(price),
+            db.func.min(price), db.func.max(price)).group_by(
+                cls.category).order_by(cls.category).all()
+        if not cls.price_in_cents:
+            return totals
+        return [row[:3] + tuple(cls.column_price(value) for value in row[3:])
+                for row in totals]
+
+    @classmethod
+    def price_range(cls, query=None):
+        """ Returns the lowest and highest price of the Products of a query """
+        query = cls.query if query is None else query
+        price = cls.price_column()
+        low, high = query.with_entities(db.func.min(price), db.func.max(price)).one()
+        return cls.column_price(low), cls.column_price(high)
+
+    @classmethod
+    def facets(cls, query=None, boundaries=()):
+        """
+        Counts the Products of a query per category, per price bucket and
+        in stock versus sold out
+        Price buckets are (low, high] ranges split at the boundaries. The
+        counts come from one GROUPING SETS query on PostgreSQL and from one
+        UNION ALL of the three groupings elsewhere
+        """
+        cls.logger.info('Processing facets with price boundaries %s', boundaries)
+        query = cls.query if query is None else query
+        if boundaries:
+            bucket = db.case([(cls.price_column() <= cls.price_value(boundary), index)
+                              for index, boundary in enumerate(boundaries)],
+                             else_=len(boundaries))
+        else:
+            bucket = db.literal(0)
+        in_stock = db.case([(cls.stock_expression() > 0, 1)], else_=0)
+        # group on the columns of a subquery so that the bound parameters of
+        # the bucket expression are not compared between SELECT and GROUP BY
+        rows = query.with_entities(cls.category.label('category'),
+                                   bucket.label('bucket'),
+                                   in_stock.label('in_stock')).subquery()
+        columns = (rows.c.category, rows.c.bucket, rows.c.in_stock)
+        if db.session.get_bind().dialect.name == 'postgresql':
+            counts = db.session.query(
+                *(columns + tuple(db.func.grouping(column) for column in columns)
+                  + (db.func.count(),))).group_by(db.func.grouping_sets(*columns))
+        else:
+            groupings = []
+            for grouped in columns:
+                groupings.append(db.select(
+                    [column if column is grouped else db.null().label(column.name)
+                     for column in columns]
+                    + [db.literal(0 if column is grouped else 1) for column in columns]
+                    + [db.func.count()]).group_by(grouped))
+            counts = db.session.execute(db.union_all(*groupings))
+        facets = {'category': [],
+                  'price': [{'low': low, 'high': high, 'count': 0} for low, high in
+                            zip((None,) + tuple(boundaries), tuple(boundaries) + (None,))],
+                  'stock': {'in_stock': 0, 'sold_out': 0}}
+        for category, index, stocked, by_category, by_bucket, by_stock, count in counts:
+            if not by_category:
+                facets['category'].append({'value': category, 'count': count})
+            elif not by_bucket:
+                facets['price'][index]['count'] = count
+            elif not by_stock:
+                facets['stock']['in_stock' if stocked else 'sold_out'] = count
+        facets['category'].sort(key=lambda facet: (facet['value'] is None, facet['value']))
+        return facets
+
+    @staticmethod
+    def price_boundaries(low, high, count):
+        """
+        Splits the prices from low to high into about count buckets of a
+        round width, returning the boundaries between them
+        Boundaries are rounded to cents, and one that rounds to the cent of
+        the one before it, or up to high, is dropped
+        """
+        if low is None or high is None or high <= low or count < 2:
+            return []
+        low, high = float(low), float(high)
+        raw = (high - low) / count
+        magnitude = 10 ** math.floor(math.log10(raw))
+        step = next(magnitude * factor for factor in (1, 2, 2.5, 5, 10)
+                    if magnitude * factor >= raw)
+        boundary = math.floor(low / step) * step + step
+        boundaries = []
+        while boundary < high:
+            rounded = round(boundary, 2)
+            if rounded < high and (not boundaries or rounded > boundaries[-1]):
+                boundaries.append(rounded)
+            boundary += step
+        return boundaries
+
+    @classmethod
+    def stats(cls, group_by=None):
+        """
+        Returns the count, stock, stock value and prices of the Products
+        Totals come from the category_stats summary when it is maintained,
+        otherwise from one aggregate query over the product table
+        """
+        if CategoryStats.enabled:
+            totals = [(row.category or None, row.count, row.stock, row.stock_value,
+                       row.price_total, row.min_price, row.max_price)
+                      for row in CategoryStats.query.order_by(CategoryStats.category)]
+        else:
+            totals = cls.category_totals()
+        if group_by is None:
+            totals = [(None,
+                       sum(row[1] for row in totals),
+                       sum(row[2] or 0 for row in totals),
+                       sum(float(row[3] or 0) for row in totals),
+                       sum(float(row[4] or 0) for row in totals),
+                       min((row[5] for row in totals if row[5] is not None), default=None),
+                       max((row[6] for row in totals if row[6] is not None), default=None))]
+        results = []
+        for category, count, stock, stock_value, price_total, min_price, max_price in totals:
+            results.append({
+                'category': category,
+                'count': count,
+                'stock': int(stock or 0),
+                'stock_value': float(stock_value or 0),
+                'min_price': float(min_price) if min_price is not None else None,
+                'avg_price': float(price_total) / count if count else None,
+                'max_price': float(max_price) if max_price is not None else None
+            })
+        return results
 
     @classmethod
     def all(cls):
         cls.logger.info('Processing all Products')
         return cls.query.all()
+
+
+class Tombstone(db.Model):
+    """
+    Class that represents a deleted Product
+    """
+    product_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    deleted_at = db.Column(db.DateTime, nullable=False)
+    __table_args__ = (db.Index('ix_tombstone_deleted_at_product_id',
+                               'deleted_at', 'product_id'),)
+
+
+# Totals are added up with a context of their own rather than the one of
+# the thread, which callers are free to narrow
+MONEY = Context(prec=28)
+
+
+class CategoryStats(db.Model):
+    """
+    Class that represents the running totals of a category
+    When enabled the totals are adjusted by every write to a Product, in
+    the same transaction, so that statistics are read without scanning
+    the product table
+    """
+    logger = logging.getLogger('app')
+    enabled = False
+
+    category = db.Column(db.String(50), primary_key=True)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    stock = db.Column(db.BigInteger, nullable=False, default=0)
+    stock_value = db.Column(numeric(28, 2), nullable=False, default=0)
+    price_total = db.Column(numeric(28, 2), nullable=False, default=0)
+    min_price = db.Column(numeric(18, 2))
+    max_price = db.Column(numeric(18, 2))
+
+    @classmethod
+    def add(cls, category, price, stock):
+        """ Adds a Product to the totals of its category """
+        key = category or ''
+        price = Decimal(str(price or 0))
+        stock = stock or 0
+        value = MONEY.multiply(price, stock)
+        updated = cls.query.filter(cls.category == key).update({
+            cls.count: cls.count + 1,
+            cls.stock: cls.stock + stock,
+            cls.stock_value: cls.stock_value + value,
+            cls.price_total: cls.price_total + price,
+            cls.min_price: db.case([(cls.min_price > price, price)], else_=cls.min_price),
+            cls.max_price: db.case([(cls.max_price < price, price)], else_=cls.max_price)
+        }, synchronize_session=False)
+        if updated:
+            return
+        try:
+            with db.session.begin_nested():
+                db.session.add(cls(category=key, count=1, stock=stock,
+                                   stock_value=value, price_total=price,
+                                   min_price=price, max_price=price))
+        except IntegrityError:
+            # another request created the category first
+            cls.add(category, price, stock)
+
+    @classmethod
+    def remove(cls, category, price, stock):
+        """
+        Removes a Product from the totals of its category
+        The lowest and highest prices are only looked up again when the
+        Product held one of them
+        """
+        key = category or ''
+        price = Decimal(str(price or 0))
+        stock = stock or 0
+        cls.query.filter(cls.category == key).update({
+            cls.count: cls.count - 1,
+            cls.stock: cls.stock - stock,
+            cls.stock_value: cls.stock_value - MONEY.multiply(price, stock),
+            cls.price_total: cls.price_total - price
+        }, synchronize_session=False)
+        totals = cls.query.populate_existing().get(key)
+        if totals is None:
+            return
+        if totals.count <= 0:
+            db.session.delete(totals)
+        elif price in (totals.min_price, totals.max_price):
+            if key:
+                products = Product.query.filter(Product.category == key)
+            else:
+                products = Product.query.filter(db.func.coalesce(Product.category, '') == '')
+            totals.min_price, totals.max_price = products.with_entities(
+                db.func.min(Product.price), db.func.max(Product.price)).one()
+
+    @classmethod
+    def take_stock(cls, category, price, amount=1):
+        """ Takes stock that was bought out of the totals of a category """
+        price = Decimal(str(price or 0))
+        cls.query.filter(cls.category == (category or '')).update({
+            cls.stock: cls.stock - amount,
+            cls.stock_value: cls.stock_value - MONEY.multiply(price, amount)
+        }, synchronize_session=False)
+
+    @classmethod
+    def rebuild(cls):
+        """ Recomputes the totals of every category from the product table """
+        cls.logger.info('Rebuilding category stats')
+        cls.query.delete()
+        totals = {}
+        for category, count, stock, stock_value, price_total, min_price, max_price \
+                in Product.category_totals():
+            key = category or ''
+            if key in totals:
+                # products without a category and with an empty one share a row
+                row = totals[key]
+                row.count += count
+                row.stock += stock or 0
+                row.stock_value = MONEY.add(row.stock_value, stock_value or 0)
+                row.price_total = MONEY.add(row.price_total, price_total or 0)
+                row.min_price = cls._either(min, row.min_price, min_price)
+                row.max_price = cls._either(max, row.max_price, max_price)
+                continue
+            totals[key] = cls(category=key, count=count, stock=stock or 0,
+                              stock_value=stock_value or 0, price_total=price_total or 0,
+                              min_price=min_price, max_price=max_price)
+        db.session.add_all(totals.values())
+        db.session.commit()
+
+    @staticmethod
+    def _either(pick, first, second):
+        """ Picks one of two prices, either of which may be None """
+        if first is None or second is None:
+            return second if first is None else first
+        return pick(first, second)
+
+    @classmethod
+    def init_summary(cls, enabled):
+        """
+        Turns the totals on or off for this process
+        A process that does not keep the totals empties them, since its
+        writes leave them behind, and a process that keeps them rebuilds
+        them when they are empty, so that turning STATS_SUMMARY back on
+        starts from the product table
+        """
+        cls.enabled = enabled
+        if not enabled:
+            if cls.query.first():
+                cls.logger.info('Dropping category stats, STATS_SUMMARY is off')
+                cls.query.delete()
+                db.session.commit()
+        elif not cls.query.first():
+            cls.rebuild()
+
+
+class StockShard(db.Model):
+    """
+    Class that represents one counter slot of a sharded Product stock
+    """
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), primary_key=True)
+    slot = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    stock = db.Column(db.Integer, nullable=False, default=0)
+
+
+class IdempotencyKey(db.Model):
+    """
+    Class that represents the stored response to an idempotent request
+    """
+    logger = logging.getLogger('app')
+
+    key = db.Column(db.String(255), primary_key=True)
+    fingerprint = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer)
+    headers = db.Column(db.Text)
+    body = db.Column(db.LargeBinary)
+    created = db.Column(db.DateTime, nullable=False, index=True, default=datetime.utcnow)
+
+    @classmethod
+    def claim(cls, key, fingerprint):
+        """
+        Claims a key for a request that is about to run
+        Returns None when the key was claimed, otherwise the stored entry
+        """
+        # insert through the table so a stale instance in the session
+        # cannot hide a key that was released meanwhile
+        insert = cls.__table__.insert().values(
+            key=key, fingerprint=fingerprint, created=datetime.utcnow())
+        try:
+            db.session.execute(insert)
+            db.session.commit()
+            return None
+        except IntegrityError:
+            db.session.rollback()
+            return cls.query.populate_existing().get(key)
+
+    @classmethod
+    def lookup(cls, key):
+        """ Finds the current state of a key bypassing the session cache """
+        return cls.query.populate_existing().get(key)
+
+    def complete(self, status, headers, body):
+        """ Stores the response of the request that claimed the key """
+        self.status = status
+        self.headers = headers
+        self.body = body
+        db.session.commit()
+
+    def release(self):
+        """ Gives up a key so that a retry runs the request again """
+        db.session.delete(self)
+        db.session.commit()
+
+    @classmethod
+    def purge(cls, ttl, max_keys):
+        """ Removes keys older than ttl seconds and caps the table at max_keys """
+        cutoff = datetime.utcnow() - timedelta(seconds=ttl)
+        cls.query.filter(cls.created < cutoff).delete(synchronize_session=False)
+        oldest = cls.query.order_by(cls.created.desc()).offset(max_keys).first()
+        if oldest:
+            cls.logger.info('Idempotency keys over capacity, dropping before %s', oldest.created)
+            cls.query.filter(cls.created <= oldest.created).delete(synchronize_session=False)
+        db.session.commit()
+
+
+class ApiKey(db.Model):
+    """
+    Class that represents an API key
+    """
+    logger = logging.getLogger('app')
+
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(50), nullable=False)
+    key_hash = db.Column(db.String(64), nullable=False, unique=True)
+    scopes = db.Column(db.String(255), nullable=False, default='')
+    revoked = db.Column(db.Boolean, nullable=False, default=False)
+    created = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+    @staticmethod
+    def digest(key):
+        """ Hashes a key, keys are random so a plain digest suffices """
+        return hashlib.sha256(key.encode('utf-8')).hexdigest()
+
+    @classmethod
+    def issue(cls, name, scopes):
+        """
+        Creates a new API key
+        Returns the ApiKey and the key, which cannot be recovered later
+        """
+        key = uuid.uuid4().hex
+        api_key = cls(name=name, key_hash=cls.digest(key), scopes=','.join(scopes))
+        cls.logger.info('Issuing API key %s with scopes %s', name, api_key.scopes)
+        db.session.add(api_key)
+        ApiKeyVersion.bump()
+        db.session.commit()
+        return api_key, key
+
+    def revoke(self):
+        """ Revokes the API key in every worker """
+        ApiKey.logger.info('Revoking API key %s', self.name)
+        self.revoked = True
+        ApiKeyVersion.bump()
+        db.session.commit()
+
+    @classmethod
+    def find_by_key(cls, key):
+        """ Finds the API key that has not been revoked for a key """
+        return cls.query.filter(cls.key_hash == cls.digest(key),
+                                cls.revoked == False).first()  # pylint: disable=singleton-comparison
+
+    @classmethod
+    def find(cls, api_key_id):
+        return cls.query.get(api_key_id)
+
+    def serialize(self):
+        """ Serializes an ApiKey into a dictionary """
+        return {"id": self.id,
+                "name": self.name,
+                "scopes": self.scopes.split(',') if self.scopes else [],
+                "revoked": self.revoked}
+
+
+class ApiKeyVersion(db.Model):
+    """
+    Class that represents the version of the API keys
+    Workers compare it with the version their cached keys were read at
+    """
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+    @classmethod
+    def current(cls):
+        version = db.session.query(cls.version).filter(cls.id == 1).scalar()
+        return version or 0
+
+    @classmethod
+    def bump(cls):
+        """ Increments the version in the current transaction """
+        if not cls.query.filter(cls.id == 1).update(
+                {cls.version: cls.version + 1}, synchronize_session=False):
+            db.session.add(cls(id=1, version=1))
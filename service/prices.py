@@ -0,0 +1,83 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Price migration
+Moves a running catalog to prices in integer cents: creates the indexes of
+the price_cents column when they are missing, then fills in the cents of
+every Product whose cents do not match its price, in short batches. The
+service adds the column when it starts and writes both columns, so the
+migration can run while it serves; run it once no worker of an older
+version is left and set PRICE_IN_CENTS=true when it is done.
+
+Usage:
+------
+python -m service.prices --batch-size 1000
+"""
+
+import sys
+import logging
+import argparse
+from service.model import Product, db
+
+logger = logging.getLogger('app')
+
+COLUMN = 'price_cents'
+
+
+def add_indexes(engine):
+    """
+    Creates the missing indexes on price_cents
+    PostgreSQL builds them CONCURRENTLY, so that writes are not blocked
+    Returns the names of the indexes created
+    """
+    existing = {index['name'] for index in db.inspect(engine).get_indexes('product')}
+    created = []
+    for index in sorted(Product.__table__.indexes, key=lambda index: index.name):
+        if COLUMN not in index.columns or index.name in existing:
+            continue
+        logger.info('Creating index %s', index.name)
+        if engine.dialect.name == 'postgresql':
+            # CONCURRENTLY cannot run inside a transaction
+            with engine.connect() as connection:
+                connection.execution_options(isolation_level='AUTOCOMMIT').execute(
+                    'CREATE INDEX CONCURRENTLY {} ON product ({})'.format(
+                        index.name, ', '.join(column.name for column in index.columns)))
+        else:
+            index.create(engine)
+        created.append(index.name)
+    return created
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Move the Product prices to integer cents')
+    parser.add_argument('--batch-size', type=int, default=1000,
+                        help='The number of Products filled per transaction')
+    args = parser.parse_args(argv)
+    if args.batch_size < 1:
+        parser.error('--batch-size must be positive')
+    from service import app
+    from service.service import init_db
+    # prices are read from the decimal column until the cents are filled in
+    app.config['PRICE_IN_CENTS'] = False
+    # adds the column when it is missing
+    init_db()
+    add_indexes(db.engine)
+    filled = Product.fill_price_cents(args.batch_size)
+    sys.stderr.write('Filled the price in cents of {} products\n'.format(filled))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
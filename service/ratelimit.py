@@ -0,0 +1,178 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Token bucket rate limiting per client
+Every client has one bucket per route class that refills at a steady rate
+up to a burst capacity, and a request is refused when its bucket is empty
+Stores
+------
+MemoryStore - keeps the buckets in this process
+RedisStore - keeps the buckets in Redis, shared by every worker
+"""
+
+import math
+import time
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger('app')
+
+
+class Limit(object):
+    """ The refill rate in tokens per second and the burst capacity of a bucket """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+
+    @classmethod
+    def parse_all(cls, value):
+        """ Parses limits written as 'read=100:200,write=20:40' """
+        limits = {}
+        for item in value.split(','):
+            if not item.strip():
+                continue
+            route_class, _, limit = item.partition('=')
+            rate, _, capacity = limit.partition(':')
+            limits[route_class.strip()] = cls(float(rate), float(capacity or rate))
+        return limits
+
+
+class MemoryStore(object):
+    """
+    Keeps the buckets of this process in a dictionary of bounded size
+    The least recently used bucket is dropped for a new one, which is the
+    one whose client went quiet for the longest
+    """
+
+    def __init__(self, size=10000):
+        self.size = size
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+
+    def take(self, key, limit, now):
+        """
+        Takes a token from a bucket
+        Returns whether it was allowed, the tokens left and the seconds to
+        wait for the next token
+        """
+        with self.lock:
+            tokens, stamp = self.buckets.get(key, (limit.capacity, now))
+            tokens = min(limit.capacity, tokens + (now - stamp) * limit.rate)
+            allowed = tokens >= 1
+            if allowed:
+                tokens -= 1
+            self.buckets[key] = (tokens, now)
+            self.buckets.move_to_end(key)
+            while len(self.buckets) > self.size:
+                self.buckets.popitem(last=False)
+        return allowed, tokens, 0 if allowed else (1 - tokens) / limit.rate
+
+    def reset(self):
+        with self.lock:
+            self.buckets.clear()
+
+
+class RedisStore(object):
+    """
+    Keeps the buckets in Redis so that every worker shares them
+    The refill and the take run in one script, so they are atomic
+    """
+
+    SCRIPT = """
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'stamp')
+local rate = tonumber(ARGV[1])
+local capacity = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local tokens = tonumber(bucket[1]) or capacity
+local stamp = tonumber(bucket[2]) or now
+tokens = math.min(capacity, tokens + math.max(0, now - stamp) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HSET', KEYS[1], 'tokens', tostring(tokens), 'stamp', tostring(now))
+redis.call('PEXPIRE', KEYS[1], math.ceil(capacity / rate * 1000) + 1000)
+return {allowed, tostring(tokens)}
+"""
+
+    def __init__(self, url):
+        try:
+            import redis
+        except ImportError:
+            raise RuntimeError('RATE_LIMIT_STORAGE {} needs the redis package'.format(url))
+        self.client = redis.Redis.from_url(url)
+        self.script = self.client.register_script(self.SCRIPT)
+
+    def take(self, key, limit, now):
+        allowed, tokens = self.script(keys=['ratelimit:' + key],
+                                      args=[limit.rate, limit.capacity, now])
+        tokens = float(tokens)
+        return bool(allowed), tokens, 0 if allowed else (1 - tokens) / limit.rate
+
+    def reset(self):
+        for key in self.client.scan_iter('ratelimit:*'):
+            self.client.delete(key)
+
+
+class RateLimiter(object):
+    """ Checks requests against the limits of their route class """
+
+    def __init__(self, store, limits):
+        self.store = store
+        self.limits = limits
+
+    def check(self, client, route_class):
+        """
+        Takes a token for a request of a client
+        Returns None when the route class is not limited, otherwise whether
+        the request is allowed and the values of its rate limit headers
+        """
+        limit = self.limits.get(route_class)
+        if limit is None:
+            return None
+        now = time.time()
+        try:
+            allowed, tokens, retry_after = self.store.take(
+                '{}:{}'.format(route_class, client), limit, now)
+        except Exception as error:  # pylint: disable=broad-except
+            # a broken store must not take the service down with it
+            logger.error('Rate limit store failed: %s', error)
+            return None
+        headers = {
+            'X-RateLimit-Limit': str(int(limit.capacity)),
+            'X-RateLimit-Remaining': str(int(tokens)),
+            'X-RateLimit-Reset': str(int(math.ceil((limit.capacity - tokens) / limit.rate)))
+        }
+        if not allowed:
+            headers['Retry-After'] = str(int(math.ceil(retry_after)))
+        return allowed, headers
+
+
+limiter = None
+
+
+def init_ratelimit(app):
+    """ Sets up the rate limiter from the configuration of the app """
+    global limiter
+    storage = app.config['RATE_LIMIT_STORAGE']
+    if storage.startswith('redis'):
+        store = RedisStore(storage)
+    else:
+        store = MemoryStore(app.config['RATE_LIMIT_BUCKETS'])
+    limiter = RateLimiter(store, Limit.parse_all(app.config['RATE_LIMITS']))
+    return limiter
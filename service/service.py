@@ -21,21 +21,47 @@ GET /products - Returns a list all of the Products
 GET /products/{id} - Returns the Product with a given id number
 POST /products - creates a new Product record in the database
 PUT /products/{id} - updates a Product record in the database
+PATCH /products/{id} - updates only the given fields of a Product record
+PATCH /products - updates the given fields of many Product records at once
 DELETE /products/{id} - deletes a Product record in the database
+DELETE /products?category={category}&max_stock={stock} - deletes the Product records that match
 GET /products?category={category} - query a list of the Products match the specific category
+GET /products?updated_since={timestamp} - returns the Products changed or deleted since a time
+GET /products?facets=true - returns the Products with their counts per category, price and stock
 PUT /products/{id}/buy - updates the purchase amoubt of a Product record
+PUT /products/{id}/shards - splits the stock of a Product across counter slots
+GET /products/changes - streams the changes to Products as server-sent events
+GET /products/export?format=csv&category={category} - exports the Products that match as a file
+GET /products/stats?group_by=category - returns the count, stock and prices of the Products
+POST /apikeys - issues a new API key
+DELETE /apikeys/{id} - revokes an API key
 """
 
 import uuid
+import base64
+import json
+import time
+import math
+import hashlib
+import tempfile
+import threading
+from collections import OrderedDict
+from datetime import datetime, timedelta, timezone
 from functools import wraps
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Flask, Response, jsonify, request, url_for, make_response, abort, g, \
+    stream_with_context, _app_ctx_stack
 from flask_api import status
 from flask import jsonify, request, url_for, make_response
-from flask_restplus import Api, Resource, fields, reqparse, inputs
+from flask_restplus import Api, Resource, fields, reqparse, inputs, marshal
+from werkzeug.test import EnvironBuilder
+from werkzeug.wsgi import wrap_file
 # Import Flask application
 from . import app
 from werkzeug.exceptions import NotFound
-from service.model import Product, DataValidationError
+from service.model import Product, IdempotencyKey, ApiKey, DataValidationError, db, \
+    single_transaction
+from service import changes, ratelimit, apikeys, export, snapshot, cache, singleflight
+from service.validation import Validator
 
 # The type of autorization required
 authorizations = {
@@ -100,22 +126,138 @@ product_model = api.model('Product', {
     'description': fields.String(required=True,
                                  description='Information describing the product'),
     'category': fields.String(required=True,
-                              description='The category of the product')
+                              description='The category of the product'),
+    'updated_at': fields.String(readOnly=True,
+                                description='When the product was last changed, in ISO 8601')
 })
 
+# prices are stored as NUMERIC(18, 2) and stock as a 32 bit INTEGER
+MAX_PRICE = 10 ** 16
+MAX_STOCK = 2 ** 31 - 1
+
 create_model = api.model('Product', {
-    'name': fields.String(required=True,
+    'name': fields.String(required=True, min_length=1, max_length=50,
                           description='The name of the product'),
-    'price': fields.Float(required=True,
+    'price': fields.Float(required=True, min=0, max=MAX_PRICE, exclusiveMax=True,
                           description='The price of the product'),
-    'stock': fields.Integer(required=True,
+    'stock': fields.Integer(required=True, min=0, max=MAX_STOCK,
                             description='The number of the product in stock'),
-    'description': fields.String(required=True,
+    'description': fields.String(required=True, max_length=255,
                                  description='Information describing the product'),
-    'category': fields.String(required=True,
+    'category': fields.String(required=True, min_length=1, max_length=50,
+                              description='The category of the product')
+})
+
+changes_model = api.model('ProductChanges', {
+    'products': fields.List(fields.Nested(product_model),
+                            description='The Products created or updated'),
+    'deleted': fields.List(fields.Integer,
+                           description='The ids of the Products deleted'),
+    'high_water_mark': fields.String(
+        description='The updated_since to send for the next sync once next is empty'),
+    'next': fields.String(description='The URL of the next page of changes')
+})
+
+patch_model = api.model('ProductPatch', {
+    'name': fields.String(min_length=1, max_length=50,
+                          description='The name of the product'),
+    'price': fields.Float(min=0, max=MAX_PRICE, exclusiveMax=True,
+                          description='The price of the product'),
+    'stock': fields.Integer(min=0, max=MAX_STOCK,
+                            description='The number of the product in stock'),
+    'description': fields.String(max_length=255,
+                                 description='Information describing the product'),
+    'category': fields.String(min_length=1, max_length=50,
                               description='The category of the product')
 })
 
+bulk_patch_model = api.inherit('ProductBulkPatch', patch_model, {
+    'id': fields.Integer(required=True, description='The id of the product to update')
+})
+
+delete_result_model = api.model('ProductDeleteResult', {
+    'deleted': fields.Integer(description='The number of Products deleted')
+})
+
+bulk_result_model = api.model('ProductBulkResult', {
+    'updated': fields.List(fields.Integer, description='The ids of the updated Products'),
+    'missing': fields.List(fields.Integer, description='The ids that were not found')
+})
+
+stats_model = api.model('ProductStats', {
+    'category': fields.String(description='The category, empty for the totals of all Products'),
+    'count': fields.Integer(description='The number of Products'),
+    'stock': fields.Integer(description='The total stock of the Products'),
+    'stock_value': fields.Float(description='The total of stock times price'),
+    'min_price': fields.Float(description='The lowest price'),
+    'avg_price': fields.Float(description='The average price'),
+    'max_price': fields.Float(description='The highest price')
+})
+
+shards_model = api.model('StockShards', {
+    'slots': fields.Integer(required=True,
+                            description='The number of stock counter slots, '
+                                        'from 1 to 64, 1 to unshard')
+})
+
+apikey_model = api.model('ApiKey', {
+    'id': fields.Integer(readOnly=True, description='The id of the API key'),
+    'name': fields.String(required=True, description='Who the API key is issued to'),
+    'scopes': fields.List(fields.String, description='The scopes granted, write or admin'),
+    'revoked': fields.Boolean(readOnly=True, description='Whether the API key was revoked'),
+    'key': fields.String(readOnly=True,
+                         description='The API key, only returned when it is issued')
+})
+
+multi_get_model = api.model('ProductLookup', {
+    'products': fields.List(fields.Nested(product_model),
+                            description='The Products found, in the order of the ids'),
+    'missing': fields.List(fields.Integer, description='The ids that were not found')
+})
+
+lookup_model = api.model('ProductIds', {
+    'ids': fields.List(fields.Integer, required=True,
+                       description='The ids of the Products to return')
+})
+
+batch_request_model = api.model('BatchRequest', {
+    'method': fields.String(required=True, description='GET, POST, PUT, PATCH or DELETE'),
+    'path': fields.String(required=True, description='The path and query string, '
+                                                     'such as /products/1'),
+    'headers': fields.Raw(description='Headers added to the ones of the batch'),
+    'body': fields.Raw(description='The JSON body of the request')
+})
+
+batch_model = api.model('Batch', {
+    'requests': fields.List(fields.Nested(batch_request_model), required=True,
+                            description='The requests, run in order'),
+    'transaction': fields.Boolean(default=False,
+                                  description='Run the requests in one transaction, '
+                                              'stopping at the first that fails')
+})
+
+batch_response_model = api.model('BatchResponse', {
+    'status': fields.Integer(description='The status code of the response'),
+    'headers': fields.Raw(description='The headers of the response'),
+    'body': fields.Raw(description='The JSON body of the response, or its text')
+})
+
+batch_result_model = api.model('BatchResult', {
+    'responses': fields.List(fields.Nested(batch_response_model),
+                             description='The responses of the requests that ran, in order'),
+    'committed': fields.Boolean(description='Whether the writes of the requests were kept')
+})
+
+API_KEY_SCOPES = ('write', 'admin')
+BATCH_METHODS = ('GET', 'POST', 'PUT', 'PATCH', 'DELETE')
+
+
+# Validators of request bodies, compiled once from the models; a partial
+# update may clear the description but no other field
+product_validator = Validator(create_model)
+patch_validator = Validator(patch_model, strict=True, nullable=('description',))
+bulk_patch_validator = Validator(bulk_patch_model, strict=True, nullable=('description',))
+
 
 # query string arguments
 product_args = reqparse.RequestParser()
@@ -125,6 +267,82 @@ product_args.add_argument('category', type=str,
                           required=False, help='List Products by category')
 product_args.add_argument(
     'price', type=int, required=False, help='List Products by price')
+product_args.add_argument('price_low', type=float, required=False,
+                          help='List Products priced above this')
+product_args.add_argument('price_high', type=float, required=False,
+                          help='List Products priced at most this')
+product_args.add_argument('max_stock', type=int, required=False,
+                          help='List Products with at most this many in stock')
+product_args.add_argument('facets', type=inputs.boolean, required=False,
+                          help='Count the matching Products per category, price and stock')
+product_args.add_argument('price_buckets', type=str, required=False,
+                          help='Comma separated price boundaries of the facets, or auto')
+product_args.add_argument('buckets', type=int, required=False,
+                          help='The number of automatic price buckets of the facets, '
+                               'at most 50')
+product_args.add_argument('ids', type=str, required=False,
+                          help='Return the Products with these comma separated ids')
+product_args.add_argument('fields', type=str, required=False,
+                          help='Return only these comma separated fields, such as id,name,price')
+product_args.add_argument('sort', type=str, required=False,
+                          help='Sort by comma separated columns that have an index, '
+                               'such as price or -updated_at')
+product_args.add_argument('after', type=str, required=False,
+                          help='The cursor of the next page of a sorted listing')
+product_args.add_argument('updated_since', type=str, required=False,
+                          help='List Products changed or deleted since an ISO 8601 time')
+product_args.add_argument('after_id', type=int, required=False,
+                          help='Resume a list of changes after this id')
+product_args.add_argument('until', type=str, required=False,
+                          help='The high water mark of a list of changes')
+product_args.add_argument('limit', type=int, required=False,
+                          help='The maximum number of changes to list')
+
+fields_args = reqparse.RequestParser()
+fields_args.add_argument('fields', type=str, required=False,
+                         help='Return only these comma separated fields, such as id,name,price')
+
+export_args = product_args.copy()
+export_args.add_argument('format', type=str, required=False, choices=export.FORMATS,
+                         help='csv, or parquet when pyarrow is installed')
+
+
+
+def filter_text(value):
+    """ A filter value that must not be empty """
+    if not value:
+        raise ValueError('must not be empty')
+    return value
+
+
+def filter_number(value):
+    """ A filter value that must be a finite number """
+    number = float(value)
+    if not math.isfinite(number):
+        raise ValueError('must be a finite number')
+    return number
+
+
+# Price ranges of the price filter
+PRICE_RANGES = {1: (0, 25), 2: (25, 50), 3: (50, 75)}
+
+# a bulk delete refuses filters it cannot apply rather than ignore them
+delete_args = reqparse.RequestParser()
+delete_args.add_argument('name', type=filter_text, help='Delete Products by name')
+delete_args.add_argument('category', type=filter_text, help='Delete Products by category')
+delete_args.add_argument('price', type=int, choices=sorted(PRICE_RANGES),
+                         help='Delete Products by price range')
+delete_args.add_argument('price_low', type=filter_number,
+                         help='Delete Products priced above this')
+delete_args.add_argument('price_high', type=filter_number,
+                         help='Delete Products priced at most this')
+delete_args.add_argument('max_stock', type=int,
+                         help='Delete Products with at most this many in stock')
+
+STATS_GROUPS = ('category',)
+stats_args = reqparse.RequestParser()
+stats_args.add_argument('group_by', type=str, required=False, choices=STATS_GROUPS,
+                        help='Group the statistics by an attribute')
 
 
 ######################################################################
@@ -135,9 +353,12 @@ def request_validation_error(error):
     """ Handles Value Errors from bad data """
     message = str(error)
     app.logger.error(message)
-    return {'status_code': status.HTTP_400_BAD_REQUEST,
+    body = {'status_code': status.HTTP_400_BAD_REQUEST,
             'error': 'Bad Request',
-            'message': message}, status.HTTP_400_BAD_REQUEST
+            'message': message}
+    if error.errors is not None:
+        body['errors'] = error.errors
+    return body, status.HTTP_400_BAD_REQUEST
 
 
 ######################################################################
@@ -147,26 +368,263 @@ def generate_apikey():
     """ Helper function for generating API keys """
     return uuid.uuid4().hex
 
-def get_apikey_for_behave():
-    return app.config['API_KEY']
-
 ######################################################################
 # Authorization Decorator
 ######################################################################
-def token_required(f):
+apikeys.init_apikeys(app)
+
+
+def token_required(f=None, scope='write'):
+    """
+    Requires an X-Api-Key header with a key that grants the scope
+    Used bare as @token_required for the write scope or as
+    @token_required(scope='admin')
+    """
+    if f is None:
+        return lambda f: token_required(f, scope)
+
     @wraps(f)
     def decorated(*args, **kwargs):
-        token = None
-        if 'X-Api-Key' in request.headers:
-            token = request.headers['X-Api-Key']
-            app.config['API_KEY'] = token
-        # if app.config.get('API_KEY') and app.config['API_KEY'] == token:
-            return f(*args, **kwargs)
-        else:
+        token = request.headers.get('X-Api-Key')
+        if not token:
             return {'message': 'Invalid or missing token'}, 401
+        granted = apikeys.verify(app, token, scope)
+        if granted is None:
+            return {'message': 'Invalid or missing token'}, 401
+        if not granted:
+            return {'message': 'The token does not grant the {} scope'.format(scope)}, 403
+        return f(*args, **kwargs)
     return decorated
 
 
+def client_identity():
+    """
+    Names the client of a request: the digest of its X-Api-Key once the key
+    is verified, or its address when it sends none
+    Returns None when the request carries a key that is not valid
+    """
+    token = request.headers.get('X-Api-Key')
+    if not token:
+        return 'address:{}'.format(request.remote_addr)
+    if apikeys.verify(app, token, 'write') is None:
+        return None
+    return 'key:' + ApiKey.digest(token)
+
+
+######################################################################
+# Rate Limiting
+######################################################################
+ratelimit.init_ratelimit(app)
+
+
+def rate_limited(route_class):
+    """ Counts a resource method against the limits of a route class """
+    def decorator(f):
+        f.rate_limit_class = route_class
+        return f
+    return decorator
+
+
+def request_route_class():
+    """
+    Tells which route class the request counts against
+    Resource methods count as read or write by their HTTP method unless
+    they name a class of their own, other routes are not limited
+    """
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    method = getattr(view_class, request.method.lower(), None)
+    if method is None:
+        return None
+    default = 'read' if request.method in ('GET', 'HEAD', 'OPTIONS') else 'write'
+    return getattr(method, 'rate_limit_class', default)
+
+
+@app.before_request
+def check_rate_limit():
+    """ Refuses requests of clients that ran out of tokens """
+    route_class = request_route_class()
+    if route_class is None:
+        return None
+    # a key only gets a bucket of its own once it is verified, so sending
+    # made up keys does not get around the limit of an address
+    client = client_identity() or 'address:{}'.format(request.remote_addr)
+    checked = ratelimit.limiter.check(client, route_class)
+    if checked is None:
+        return None
+    allowed, headers = checked
+    g.rate_limit_headers = headers
+    if allowed:
+        return None
+    app.logger.warning('Rate limit of %s exceeded for %s', route_class, client)
+    return make_response(jsonify(
+        status=status.HTTP_429_TOO_MANY_REQUESTS,
+        error='Too Many Requests',
+        message='Rate limit exceeded, retry in {} seconds'.format(headers['Retry-After'])),
+        status.HTTP_429_TOO_MANY_REQUESTS)
+
+
+@app.after_request
+def add_rate_limit_headers(response):
+    """ Tells clients how many requests they have left """
+    response.headers.extend(g.pop('rate_limit_headers', {}))
+    return response
+
+
+######################################################################
+# Idempotency-Key Handling
+######################################################################
+IDEMPOTENCY_HEADER = 'Idempotency-Key'
+REPLAYED_HEADERS = ('Content-Type', 'Location')
+# Responses that depend on who sent a request or when, which a retry
+# must not get back
+UNSTORED_STATUSES = (status.HTTP_401_UNAUTHORIZED, status.HTTP_403_FORBIDDEN,
+                     status.HTTP_429_TOO_MANY_REQUESTS)
+IDEMPOTENCY_PURGE_EVERY = 100
+# the longest a waiting retry goes without looking at the stored key
+IDEMPOTENCY_POLL = 0.5
+idempotency_claims = 0
+# notified whenever a request of this worker stores or releases a key
+idempotency_done = threading.Condition()
+
+
+def idempotent(f):
+    """ Marks a resource method whose response is replayed for retries """
+    f.idempotent = True
+    return f
+
+
+def idempotent_request():
+    """ Tells if the resource method handling the request is idempotent """
+    view = app.view_functions.get(request.endpoint)
+    view_class = getattr(view, 'view_class', None)
+    method = getattr(view_class, request.method.lower(), None)
+    return getattr(method, 'idempotent', False)
+
+
+def request_fingerprint():
+    """ Digests the parts of a request that a retry must repeat """
+    digest = hashlib.sha256()
+    digest.update(request.method.encode())
+    digest.update(request.full_path.encode())
+    digest.update(request.get_data())
+    return digest.hexdigest()
+
+
+def scoped_idempotency_key(key):
+    """
+    Scopes an Idempotency-Key to the client that sent it, so that clients
+    cannot collide with or read back each other's keys
+    Returns None when the client is not known
+    """
+    identity = client_identity()
+    if identity is None:
+        return None
+    return hashlib.sha256('{}\n{}'.format(identity, key).encode('utf-8')).hexdigest()
+
+
+def wait_idempotency_key(timeout):
+    """ Waits until a request of this worker is done with a key, or timeout seconds """
+    with idempotency_done:
+        idempotency_done.wait(timeout)
+
+
+def idempotency_key_done():
+    with idempotency_done:
+        idempotency_done.notify_all()
+
+
+def replay_response(entry):
+    """ Rebuilds the stored response of an Idempotency-Key """
+    response = Response(entry.body, status=entry.status,
+                        headers=json.loads(entry.headers))
+    response.headers['Idempotent-Replayed'] = 'true'
+    return response
+
+
+@app.before_request
+def check_idempotency_key():
+    """ Replays or waits on requests whose Idempotency-Key was seen before """
+    global idempotency_claims
+    header = request.headers.get(IDEMPOTENCY_HEADER)
+    if not header or not idempotent_request():
+        return None
+    key = scoped_idempotency_key(header)
+    if key is None:
+        # an invalid X-Api-Key is refused by the request itself
+        return None
+    fingerprint = request_fingerprint()
+    ttl = app.config['IDEMPOTENCY_TTL']
+    deadline = time.monotonic() + app.config['IDEMPOTENCY_WAIT']
+    poll = 0.05
+    entry = IdempotencyKey.claim(key, fingerprint)
+    while entry is not None:
+        if entry.created < datetime.utcnow() - timedelta(seconds=ttl):
+            app.logger.info('Idempotency key %s expired', header)
+            entry.release()
+        elif entry.fingerprint != fingerprint:
+            return make_response(jsonify(
+                status=status.HTTP_400_BAD_REQUEST,
+                error='Bad Request',
+                message='Idempotency-Key was used for a different request'),
+                status.HTTP_400_BAD_REQUEST)
+        elif entry.status is not None:
+            app.logger.info('Replaying response for idempotency key %s', header)
+            return replay_response(entry)
+        elif time.monotonic() > deadline:
+            return make_response(jsonify(
+                status=status.HTTP_409_CONFLICT,
+                error='Conflict',
+                message='A request with this Idempotency-Key is in progress'),
+                status.HTTP_409_CONFLICT)
+        else:
+            # the first request is still running: wake up when this worker
+            # finishes a request, or poll less and less often for another one
+            wait_idempotency_key(min(poll, deadline - time.monotonic()))
+            poll = min(poll * 2, IDEMPOTENCY_POLL)
+            entry = IdempotencyKey.lookup(key)
+            continue
+        entry = IdempotencyKey.claim(key, fingerprint)
+    g.idempotency_key = key
+    idempotency_claims += 1
+    if idempotency_claims % IDEMPOTENCY_PURGE_EVERY == 0:
+        IdempotencyKey.purge(ttl, app.config['IDEMPOTENCY_MAX_KEYS'])
+    return None
+
+
+@app.after_request
+def store_idempotent_response(response):
+    """ Stores the response of a request that claimed an Idempotency-Key """
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return response
+    entry = IdempotencyKey.lookup(key)
+    if entry is None:
+        return response
+    if response.status_code >= 500 or response.status_code in UNSTORED_STATUSES:
+        # let a retry run the request again
+        entry.release()
+    else:
+        headers = {name: response.headers[name]
+                   for name in REPLAYED_HEADERS if name in response.headers}
+        entry.complete(response.status_code, json.dumps(headers), response.get_data())
+    idempotency_key_done()
+    return response
+
+
+@app.teardown_request
+def release_idempotency_key(error=None):
+    """ Releases the Idempotency-Key of a request that failed """
+    key = g.pop('idempotency_key', None)
+    if key is None:
+        return
+    db.session.rollback()
+    entry = IdempotencyKey.lookup(key)
+    if entry is not None and entry.status is None:
+        entry.release()
+    idempotency_key_done()
+
+
 ######################################################################
 #  PATH: /products/{id}
 ######################################################################
@@ -185,19 +643,31 @@ class ProductResource(Resource):
     # RETRIEVE A PRODUCT
     # ------------------------------------------------------------------
     @api.doc('get_products')
+    @api.expect(fields_args, validate=True)
+    @api.response(200, 'Success', product_model)
     @api.response(404, 'Product not found')
-    @api.marshal_with(product_model)
     def get(self, product_id):
         """
         Retrieve a single Product 
         This endpoint will return a Product based on it's id
         """
         app.logger.info('Request for product with id: %s', product_id)
-        product = Product.find(product_id)
-        if not product:
+        names = requested_fields()
+
+        def read():
+            found = Product.serialize_all(Product.query.filter(Product.id == product_id),
+                                          names)
+            return found[0] if found else None
+        # concurrent requests for the same Product share one query, except
+        # in a batch transaction that reads its own writes
+        if changes.held():
+            found = read()
+        else:
+            found = singleflight.group.do(('product', product_id, tuple(names or ())), read)
+        if not found:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Product with id '{}' was not found.".format(product_id))
-        return product.serialize(), status.HTTP_200_OK
+        return marshal(found, fields_model(names)), status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -217,11 +687,36 @@ class ProductResource(Resource):
                       "Product with id {} was not found.".format(product_id))
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
+        check_body(product_validator, data)
         product.deserialize(data)
         product.id = product_id
         product.save()
         return product.serialize(), status.HTTP_200_OK
 
+    # ------------------------------------------------------------------
+    # UPDATE FIELDS OF AN EXISTING PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc('patch_products', security='apikey')
+    @api.response(404, 'Product not found')
+    @api.response(400, 'The posted Product data was not valid')
+    @api.expect(patch_model)
+    @api.marshal_with(product_model)
+    @token_required
+    def patch(self, product_id):
+        """
+        Update fields of a Product
+        Only the fields in the body are written
+        """
+        app.logger.info('Request to patch product with id: %s', product_id)
+        check_content_type('application/json')
+        app.logger.debug('Payload = %s', api.payload)
+        check_body(patch_validator, api.payload)
+        product = Product.patch(product_id, api.payload)
+        if not product:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product with id {} was not found.".format(product_id))
+        return product, status.HTTP_200_OK
+
     # ------------------------------------------------------------------
     # DELETE A PRODUCT
     # ------------------------------------------------------------------
@@ -240,6 +735,13 @@ class ProductResource(Resource):
 ######################################################################
 #  PATH: /products
 ######################################################################
+SYNC_PAGE_SIZE = 100
+FACET_PRICE_BUCKETS = 4
+FACET_MAX_BUCKETS = 50
+SYNC_MAX_PAGE_SIZE = 1000
+PAGE_SIZE = 100
+PAGE_MAX_SIZE = 1000
+
 @api.route('/products', strict_slashes=False)
 class ProductCollection(Resource):
     """ Handles all interactions with collections of Products """
@@ -249,33 +751,150 @@ class ProductCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_products')
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.response(200, 'Success', [product_model])
+    @api.response(400, 'The sync parameters were not valid')
     def get(self):
         """Returns all of the Products"""
         app.logger.info('Request for product list')
-        products = []
-        category = request.args.get('category')
-        name = request.args.get('name')
-        price = request.args.get('price')
-        if category:
-            products = Product.find_by_category(category)
-        elif name:
-            products = Product.find_by_name(name)
-        elif price and int(price) > 0 and int(price) < 4:  # query price by range
-            if int(price) == 1:
-                products = Product.find_by_price(0, 25)
-            elif int(price) == 2:
-                products = Product.find_by_price(25, 50)
-            else:
-                products = Product.find_by_price(50, 75)
+        if request.args.get('updated_since'):
+            return self.list_changes()
+        if changes.held():
+            # a batch transaction reads its own writes, which are not committed
+            return self.list_products(), status.HTTP_200_OK
+        if not request.args and snapshot.snapshot is not None:
+            opened = snapshot.snapshot.open()
+            if opened is not None:
+                return snapshot_response(*opened)
+        # identical listings running at the same time share one query
+        key = ('products', cache.normalize(request.args))
+        if cache.cache is None:
+            return singleflight.group.do(key, self.list_products), status.HTTP_200_OK
+        body = singleflight.group.do(key, lambda: cache.cache.fetch(
+            request.args, lambda: json.dumps(self.list_products()) + '\n'))
+        return Response(body, mimetype='application/json')
+
+    @staticmethod
+    def list_products():
+        """ Returns the Products that match the filters, with facets when asked """
+        names = requested_fields()
+        if request.args.get('ids'):
+            return lookup_products(parse_ids(request.args['ids']), names)
+        query = product_query()
+        keys = requested_sort()
+        limit = integer_arg('limit')
+        after = request.args.get('after')
+        paged = limit is not None or after is not None
+        if paged and keys is None:
+            keys = [('id', False)]
+        rows = query
+        if keys:
+            # a category filter lets an index that leads with category serve the sort
+            Product.check_sort(keys, ('category',) if request.args.get('category') else ())
+            if paged:
+                limit = min(limit or PAGE_SIZE, PAGE_MAX_SIZE)
+            rows = Product.sorted_page(query, keys, decode_cursor(after) if after else None,
+                                       limit if paged else None)
+        sort_names = [name for name, _ in keys or () if name != 'id'] + ['id']
+        # read only the columns of the fields asked for, and of the cursor
+        items = Product.serialize_all(rows, names and names + [
+            name for name in sort_names if paged and name not in names])
+        results = marshal(items, fields_model(names))
+        facets = request.args.get('facets', False, type=inputs.boolean)
+        if not paged and not facets:
+            return results
+        listing = {'products': results}
+        if facets:
+            listing['facets'] = Product.facets(query, price_boundaries(query))
+        if paged:
+            listing['next'] = None
+            if len(items) == limit:
+                cursor = encode_cursor([items[-1][name] for name in sort_names])
+                listing['next'] = url_for('product_collection', _external=True,
+                                          **dict(request.args.items(), after=cursor))
+        return listing
+
+    def list_changes(self):
+        """
+        Returns a page of the Products changed or deleted since a time
+        Every page of a sync shares the same high water mark, which lags
+        behind the clock so that rows still being committed are not skipped
+        """
+        since = parse_timestamp(request.args['updated_since'])
+        until = request.args.get('until')
+        if until:
+            until = parse_timestamp(until)
         else:
-            products = Product.all()
-        results = [product.serialize() for product in products]
-        return results, status.HTTP_200_OK
+            until = datetime.utcnow() - timedelta(seconds=app.config['SYNC_SAFETY_LAG'])
+        after_id = integer_arg('after_id', 0, minimum=0)
+        limit = min(integer_arg('limit', SYNC_PAGE_SIZE), SYNC_MAX_PAGE_SIZE)
+        found = Product.find_changed(since, after_id, until, limit)
+        next_url = None
+        if len(found) == limit:
+            last_time, last_id, _ = found[-1]
+            next_url = url_for('product_collection', updated_since=last_time.isoformat(),
+                               after_id=last_id, until=until.isoformat(), limit=limit,
+                               _external=True)
+        results = {
+            'products': [product.serialize() for _, _, product in found if product],
+            'deleted': [product_id for _, product_id, product in found if not product],
+            'high_water_mark': until.isoformat(),
+            'next': next_url
+        }
+        return marshal(results, changes_model), status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # DELETE THE PRODUCTS THAT MATCH
+    # ------------------------------------------------------------------
+    @api.doc('bulk_delete_products', security='apikey')
+    @api.expect(delete_args, validate=True)
+    @api.response(400, 'No filter was given or a filter was not valid')
+    @api.marshal_with(delete_result_model)
+    @token_required
+    def delete(self):
+        """
+        Delete the Products that match the filters
+        Takes the filters of the listing, at least one is required and
+        the Products must match every filter given
+        """
+        app.logger.info('Request to delete matching products')
+        args = delete_args.parse_args(strict=True)
+        if all(value is None for value in args.values()):
+            raise DataValidationError('Invalid delete: at least one filter is required, '
+                                      'use /products/reset to delete everything')
+        deleted = Product.delete_matching(delete_query(args), app.config['BULK_DELETE_BATCH'])
+        app.logger.info('Deleted %d products', deleted)
+        return {'deleted': deleted}, status.HTTP_200_OK
+
+    # ------------------------------------------------------------------
+    # UPDATE FIELDS OF MANY PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('bulk_patch_products', security='apikey')
+    @api.expect([bulk_patch_model])
+    @api.response(400, 'The posted Product data was not valid')
+    @api.marshal_with(bulk_result_model)
+    @token_required
+    def patch(self):
+        """
+        Update fields of many Products
+        All of the updates are applied in one transaction
+        """
+        app.logger.info('Request to patch many products')
+        check_content_type('application/json')
+        items = api.payload
+        if not isinstance(items, list):
+            raise DataValidationError('Invalid products: body must be a list of updates')
+        invalid = bulk_patch_validator.validate_many(items)
+        if invalid:
+            raise DataValidationError(
+                'Invalid products: {} of {} updates are not valid'.format(
+                    len(invalid), len(items)), invalid)
+        updated, missing = Product.patch_many(items)
+        return {'updated': updated, 'missing': missing}, status.HTTP_200_OK
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT
     # ------------------------------------------------------------------
+    @idempotent
     @api.doc('create_products', security='apikey')
     @api.expect(create_model)
     @api.response(400, 'The posted Product data was not valid')
@@ -291,12 +910,132 @@ class ProductCollection(Resource):
         check_content_type('application/json')
         product = Product()
         app.logger.debug('Payload = %s', api.payload)
+        check_body(product_validator, api.payload)
         product.deserialize(api.payload)
         product.save()
         location_url = api.url_for(
             ProductResource, product_id=product.id, _external=True)
         return product.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /products/lookup
+######################################################################
+@api.route('/products/lookup')
+class ProductLookupResource(Resource):
+    """ Returns many Products by id, for lists of ids too long for a URL """
+    # ------------------------------------------------------------------
+    # RETRIEVE PRODUCTS BY ID
+    # ------------------------------------------------------------------
+    @api.doc('lookup_products')
+    @api.response(400, 'The posted ids were not valid')
+    @api.expect(lookup_model)
+    @api.marshal_with(multi_get_model)
+    @rate_limited('read')
+    def post(self):
+        """Returns the Products with the ids, in their order"""
+        check_content_type('application/json')
+        data = api.payload
+        product_ids = data.get('ids') if isinstance(data, dict) else None
+        if not isinstance(product_ids, list) or not all(
+                isinstance(product_id, int) and not isinstance(product_id, bool)
+                for product_id in product_ids):
+            raise DataValidationError('Invalid lookup: ids must be a list of integers')
+        return lookup_products(product_ids), status.HTTP_200_OK
+
+
+def requested_fields():
+    """ Returns the fields asked for with ?fields=, or None for all of them """
+    value = request.args.get('fields')
+    if not value:
+        return None
+    names = list(OrderedDict.fromkeys(name.strip() for name in value.split(',')
+                                      if name.strip()))
+    unknown = [name for name in names if name not in product_model]
+    if unknown or not names:
+        raise DataValidationError('Invalid fields: must be some of {}'.format(
+            ', '.join(product_model)))
+    return names
+
+
+def fields_model(names):
+    """ Narrows the Product model to some fields """
+    if not names:
+        return product_model
+    return OrderedDict((name, product_model[name]) for name in names)
+
+
+def requested_sort():
+    """ Returns the (column, descending) pairs of ?sort=, or None when not sorted """
+    value = request.args.get('sort')
+    if not value:
+        return None
+    keys = [(name.strip().lstrip('-'), name.strip().startswith('-'))
+            for name in value.split(',') if name.strip()]
+    if not keys:
+        raise DataValidationError('Invalid sort: {}'.format(value))
+    return keys
+
+
+def encode_cursor(values):
+    """ Encodes the sort values of the last row of a page """
+    return base64.urlsafe_b64encode(json.dumps(values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Decodes a cursor of encode_cursor """
+    try:
+        values = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')).decode('utf-8'))
+    except ValueError:
+        raise DataValidationError('Invalid page: the cursor is not valid')
+    if not isinstance(values, list):
+        raise DataValidationError('Invalid page: the cursor is not valid')
+    return values
+
+
+def integer_arg(name, default=None, minimum=1):
+    """
+    Reads an integer query argument, which must be at least minimum
+    Returns default when the argument is missing
+    """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        number = None
+    if number is None or number < minimum:
+        raise DataValidationError('Invalid argument: {} must be an integer of at least {}'.format(
+            name, minimum))
+    return number
+
+
+def parse_ids(value):
+    """ Parses comma separated Product ids """
+    try:
+        return [int(product_id) for product_id in value.split(',') if product_id.strip()]
+    except ValueError:
+        raise DataValidationError('Invalid lookup: ids must be comma separated integers')
+
+
+def lookup_products(product_ids, names=None):
+    """
+    Finds the Products of the ids in one query and tells which are missing
+    Only the fields in names are read and returned when it is given
+    """
+    product_ids = list(OrderedDict.fromkeys(product_ids))
+    if len(product_ids) > app.config['MULTI_GET_MAX_IDS']:
+        raise DataValidationError('Invalid lookup: at most {} ids'.format(
+            app.config['MULTI_GET_MAX_IDS']))
+    app.logger.info('Request for %d products by id', len(product_ids))
+    rows = Product.serialize_all(Product.query.filter(Product.ids_condition(product_ids)),
+                                 names and ['id'] + [name for name in names if name != 'id'])
+    found = {row['id']: row for row in rows}
+    items = [found[product_id] for product_id in product_ids if product_id in found]
+    return {'products': marshal(items, fields_model(names)),
+            'missing': [product_id for product_id in product_ids if product_id not in found]}
+
+
 ######################################################################
 #  PATH: /products/{id}/buy
 ######################################################################
@@ -307,6 +1046,8 @@ class BuyResource(Resource):
     # ------------------------------------------------------------------
     # BUY A PRODUCT
     # ------------------------------------------------------------------
+    @idempotent
+    @rate_limited('buy')
     @api.doc('buy_products')
     @api.response(404, 'Product not found')
     @api.response(409, 'The Product is not available for purchase')
@@ -318,15 +1059,349 @@ class BuyResource(Resource):
         if not product:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Product with id '{}' was not found.".format(product_id))
-        elif product.stock == 0:
+        elif not product.buy():
             api.abort(status.HTTP_409_CONFLICT,
                       "Product with id '{}' has been sold out!".format(product_id))
-        else:
-            product.stock = product.stock - 1
-        product.save()
         app.logger.info('Product with id [%s] has been bought!', product.id)
         return product.serialize(), status.HTTP_200_OK
 
+######################################################################
+#  PATH: /products/stats
+######################################################################
+@api.route('/products/stats')
+class StatsResource(Resource):
+    """ Aggregate statistics of the Products """
+    # ------------------------------------------------------------------
+    # PRODUCT STATISTICS
+    # ------------------------------------------------------------------
+    @api.doc('stats_products')
+    @api.expect(stats_args)
+    @api.response(400, 'The grouping was not valid')
+    @api.marshal_list_with(stats_model)
+    def get(self):
+        """Returns the count, stock, stock value and prices of the Products"""
+        app.logger.info('Request for product stats')
+        group_by = request.args.get('group_by')
+        if group_by is not None and group_by not in STATS_GROUPS:
+            raise DataValidationError('Invalid stats: cannot group by {}'.format(group_by))
+        return Product.stats(group_by), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/export
+######################################################################
+EXPORT_SPOOL_SIZE = 16 * 1024 * 1024
+EXPORT_TYPES = {'csv': 'text/csv', 'parquet': 'application/vnd.apache.parquet'}
+
+@api.route('/products/export')
+class ExportResource(Resource):
+    """ Catalog files of the Products """
+    # ------------------------------------------------------------------
+    # EXPORT THE PRODUCTS THAT MATCH
+    # ------------------------------------------------------------------
+    @api.doc('export_products')
+    @api.expect(export_args)
+    @api.produces(list(EXPORT_TYPES.values()))
+    @api.response(200, 'The Products as a file')
+    @api.response(400, 'The format is not supported')
+    def get(self):
+        """
+        Export the Products that match the filters
+        Takes the same filters as the listing and streams every match in one query
+        """
+        export_format = request.args.get('format', 'csv')
+        app.logger.info('Request to export products as %s', export_format)
+        if export_format not in export.FORMATS:
+            raise DataValidationError('Invalid export: format must be one of {}'.format(
+                ', '.join(export.FORMATS)))
+        query = product_query()
+        headers = {'Content-Disposition':
+                   'attachment; filename=products.{}'.format(export_format)}
+        if export_format == 'csv':
+            return Response(stream_with_context(export.stream_csv(query)),
+                            mimetype=EXPORT_TYPES['csv'], headers=headers)
+        # Parquet writes its footer last, so the file is spooled before sending
+        output = tempfile.SpooledTemporaryFile(EXPORT_SPOOL_SIZE)
+        try:
+            export.write_parquet(query, output)
+        except RuntimeError as error:
+            output.close()
+            raise DataValidationError(str(error))
+        output.seek(0)
+
+        def generate():
+            with output:
+                for chunk in iter(lambda: output.read(64 * 1024), b''):
+                    yield chunk
+
+        return Response(generate(), mimetype=EXPORT_TYPES['parquet'], headers=headers)
+
+######################################################################
+#  PATH: /products/{id}/shards
+######################################################################
+MAX_SHARDS = 64
+
+@api.route('/products/<product_id>/shards')
+@api.param('product_id', 'The Product identifier')
+class ShardResource(Resource):
+    """ Stock sharding of a hot Product """
+    # ------------------------------------------------------------------
+    # SHARD THE STOCK OF A PRODUCT
+    # ------------------------------------------------------------------
+    @api.doc('shard_products', security='apikey')
+    @api.response(404, 'Product not found')
+    @api.response(400, 'The number of slots was not valid')
+    @api.expect(shards_model)
+    @api.marshal_with(product_model)
+    @token_required
+    def put(self, product_id):
+        """Split the stock of a Product across counter slots"""
+        app.logger.info('Request to shard stock of product with id: %s', product_id)
+        check_content_type('application/json')
+        product = Product.find(product_id)
+        if not product:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product with id '{}' was not found.".format(product_id))
+        slots = (api.payload or {}).get('slots')
+        if not isinstance(slots, int) or isinstance(slots, bool) or \
+                not 1 <= slots <= MAX_SHARDS:
+            raise DataValidationError(
+                'Invalid shards: slots must be an integer from 1 to {}'.format(MAX_SHARDS))
+        product.shard_stock(slots)
+        return product.serialize(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /apikeys
+######################################################################
+@api.route('/apikeys', strict_slashes=False)
+class ApiKeyCollection(Resource):
+    """ Issues API keys """
+    # ------------------------------------------------------------------
+    # ISSUE A NEW API KEY
+    # ------------------------------------------------------------------
+    @api.doc('create_apikeys', security='apikey')
+    @api.response(400, 'The posted data was not valid')
+    @api.response(403, 'The API key does not grant the admin scope')
+    @api.expect(apikey_model)
+    @api.marshal_with(apikey_model, code=201)
+    @token_required(scope='admin')
+    def post(self):
+        """Issue an API key, the key is only returned this once"""
+        app.logger.info('Request to issue an API key')
+        check_content_type('application/json')
+        data = api.payload or {}
+        name = data.get('name')
+        scopes = data.get('scopes', ['write'])
+        if not isinstance(name, str) or not name:
+            raise DataValidationError('Invalid API key: missing name')
+        if not isinstance(scopes, list) or not set(scopes) <= set(API_KEY_SCOPES):
+            raise DataValidationError(
+                'Invalid API key: scopes must be some of {}'.format(', '.join(API_KEY_SCOPES)))
+        api_key, key = ApiKey.issue(name, scopes)
+        message = dict(api_key.serialize(), key=key)
+        location_url = api.url_for(ApiKeyResource, api_key_id=api_key.id, _external=True)
+        return message, status.HTTP_201_CREATED, {'Location': location_url}
+
+
+@api.route('/apikeys/<int:api_key_id>')
+@api.param('api_key_id', 'The API key identifier')
+class ApiKeyResource(Resource):
+    """ Revokes an API key """
+    # ------------------------------------------------------------------
+    # REVOKE AN API KEY
+    # ------------------------------------------------------------------
+    @api.doc('delete_apikeys', security='apikey')
+    @api.response(204, 'API key revoked')
+    @api.response(403, 'The API key does not grant the admin scope')
+    @token_required(scope='admin')
+    def delete(self, api_key_id):
+        """Revoke an API key in every worker"""
+        app.logger.info('Request to revoke API key with id: %s', api_key_id)
+        api_key = ApiKey.find(api_key_id)
+        if api_key and not api_key.revoked:
+            api_key.revoke()
+        return '', status.HTTP_204_NO_CONTENT
+
+######################################################################
+#  PATH: /batch
+######################################################################
+@api.route('/batch', strict_slashes=False)
+class BatchResource(Resource):
+    """ Runs several requests in one round trip """
+    # ------------------------------------------------------------------
+    # RUN A BATCH OF REQUESTS
+    # ------------------------------------------------------------------
+    @api.doc('run_batch')
+    @api.response(400, 'The posted batch was not valid')
+    @api.expect(batch_model)
+    @api.marshal_with(batch_result_model)
+    # every request of the batch counts against its own route class
+    @rate_limited(None)
+    def post(self):
+        """Run an ordered list of requests and return each response"""
+        check_content_type('application/json')
+        data = api.payload
+        items = data.get('requests') if isinstance(data, dict) else None
+        if not isinstance(items, list) or not items:
+            raise DataValidationError('Invalid batch: requests must be a non-empty list')
+        if len(items) > app.config['BATCH_MAX_REQUESTS']:
+            raise DataValidationError('Invalid batch: at most {} requests'.format(
+                app.config['BATCH_MAX_REQUESTS']))
+        errors = [{'index': index, 'errors': found}
+                  for index, found in enumerate(map(check_batch_request, items)) if found]
+        if errors:
+            raise DataValidationError('Invalid batch: some requests are not valid', errors)
+        app.logger.info('Request to run a batch of %d requests', len(items))
+        if not data.get('transaction', False):
+            return {'responses': [dispatch(item) for item in items], 'committed': True}
+        responses = []
+        try:
+            with single_transaction():
+                for item in items:
+                    responses.append(dispatch(item))
+                    if responses[-1]['status'] >= 400:
+                        raise BatchAborted()
+        except BatchAborted:
+            app.logger.info('Rolled back a batch at request %d', len(responses) - 1)
+            return {'responses': responses, 'committed': False}
+        return {'responses': responses, 'committed': True}
+
+
+class BatchAborted(Exception):
+    """ Rolls back a batch transaction after a request failed """
+
+
+def check_batch_request(item):
+    """ Returns the errors of a request of a batch """
+    if not isinstance(item, dict):
+        return ['must be an object']
+    errors = []
+    if item.get('method') not in BATCH_METHODS:
+        errors.append('method must be one of {}'.format(', '.join(BATCH_METHODS)))
+    path = item.get('path')
+    if not isinstance(path, str) or not path.startswith('/'):
+        errors.append('path must start with /')
+    elif path.split('?')[0].rstrip('/') == '/batch':
+        errors.append('path must not be a batch')
+    if not isinstance(item.get('headers', {}), dict):
+        errors.append('headers must be an object')
+    return errors
+
+
+def inherited_header(name):
+    """ Tells if a request of a batch carries a header of the batch """
+    name = name.lower()
+    # an Idempotency-Key or a condition belongs to the batch, not to each request
+    return name not in ('content-type', 'content-length', 'idempotency-key') and \
+        not name.startswith('if-')
+
+
+def dispatch(item):
+    """
+    Runs a request of a batch in the app context of the batch
+    It carries the headers of the batch, such as X-Api-Key, and its own,
+    and gets a g of its own
+    """
+    headers = {name: value for name, value in request.headers.items()
+               if inherited_header(name)}
+    headers.update(item.get('headers') or {})
+    builder = EnvironBuilder(path=item['path'], method=item['method'],
+                             base_url=request.url_root, headers=headers,
+                             json=item.get('body'),
+                             environ_base={'REMOTE_ADDR': request.remote_addr})
+    try:
+        environ = builder.get_environ()
+    finally:
+        builder.close()
+    # a new app context would remove the session of a batch transaction
+    # when it ends, so only g is swapped
+    context = _app_ctx_stack.top
+    outer_g = context.g
+    context.g = app.app_ctx_globals_class()
+    try:
+        return dispatch_in_context(environ)
+    finally:
+        context.g = outer_g
+
+
+def dispatch_in_context(environ):
+    """ Runs the request of an environ and returns its status, headers and body """
+    with app.request_context(environ):
+        try:
+            response = app.full_dispatch_request()
+        except Exception as error:  # pylint: disable=broad-except
+            response = app.make_response(app.handle_exception(error))
+        try:
+            if response.direct_passthrough:
+                response.direct_passthrough = False
+            elif response.is_streamed:
+                return {'status': status.HTTP_400_BAD_REQUEST, 'headers': {},
+                        'body': {'message': 'A streamed response cannot be batched'}}
+            body = response.get_json(silent=True) if response.is_json else None
+            if body is None:
+                body = response.get_data(as_text=True)
+            return {'status': response.status_code,
+                    'headers': {name: value for name, value in response.headers.items()
+                                if name != 'Content-Length'},
+                    'body': body}
+        finally:
+            response.close()
+
+
+######################################################################
+# STREAM PRODUCT CHANGES
+######################################################################
+CHANGE_FEED_HEARTBEAT = 15
+# every stream holds a thread of its worker for as long as it is open
+change_streams = threading.BoundedSemaphore(app.config['CHANGE_FEED_MAX_STREAMS'])
+
+
+def format_event(event_id, kind, data):
+    """ Formats a change event for a text/event-stream """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(event_id, kind, json.dumps(data))
+
+
+@app.route('/products/changes')
+def stream_product_changes():
+    """
+    Stream create, update, delete, stock and reset events as they happen
+    A client whose Last-Event-ID has left the feed gets a resync event and
+    must read the catalog again before it applies the events that follow
+    """
+    app.logger.info('Request to stream product changes')
+    if not change_streams.acquire(blocking=False):
+        app.logger.warning('Refused a change stream, %d are open',
+                           app.config['CHANGE_FEED_MAX_STREAMS'])
+        response = make_response(jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                                         error='Service Unavailable',
+                                         message='Too many change streams are open'),
+                                 status.HTTP_503_SERVICE_UNAVAILABLE)
+        response.headers['Retry-After'] = str(CHANGE_FEED_HEARTBEAT)
+        return response
+    feed = changes.broker.feed
+    cursor = feed.cursor(request.headers.get('Last-Event-ID'))
+    resync = None
+    if cursor is None:
+        cursor, resync = feed.end()
+
+    def generate():
+        position = cursor
+        # tell the browser how long to wait before reconnecting
+        yield 'retry: 3000\n\n'
+        if resync is not None:
+            yield format_event(resync, 'resync', {})
+        while True:
+            position, events = feed.read(position, CHANGE_FEED_HEARTBEAT)
+            if not events:
+                yield ': heartbeat\n\n'
+            for event in events:
+                yield format_event(*event)
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream',
+                        headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+    # closing the response frees the slot, even when the stream never started
+    response.call_on_close(change_streams.release)
+    return response
+
 ######################################################################
 # DELETE ALL PRODUCTS (for testing only)
 ######################################################################
@@ -385,6 +1460,119 @@ def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Product.init_db(app)
+    snapshot.init_snapshot(app, render_catalog, Product.last_changed)
+
+
+cache.init_cache(app)
+singleflight.init_singleflight(app)
+changes.listeners.append(snapshot.changed)
+changes.listeners.append(cache.changed)
+changes.listeners.append(singleflight.changed)
+
+
+def render_catalog():
+    """ Renders the unfiltered listing of the Products for the snapshot """
+    with app.app_context():
+        try:
+            products = Product.query.order_by(Product.id).all()
+            results = marshal([product.serialize() for product in products], product_model)
+            return (json.dumps(results) + '\n').encode('utf-8')
+        finally:
+            db.session.remove()
+
+
+def snapshot_response(catalog, version):
+    """ Sends the snapshot file, with sendfile when the server supports it """
+    response = Response(wrap_file(request.environ, catalog), mimetype='application/json',
+                        direct_passthrough=True)
+    response.headers['X-Catalog-Version'] = version
+    return response
+
+
+def product_query():
+    """
+    Builds the query of the Products that match the listing filters
+    """
+    query = filter_query()
+    max_stock = request.args.get('max_stock', type=int)
+    if max_stock is not None:
+        query = query.filter(Product.stock_expression() <= max_stock)
+    return query
+
+
+def filter_query():
+    """ Selects the Products by the first of the attribute filters given """
+    category = request.args.get('category')
+    name = request.args.get('name')
+    price = request.args.get('price')
+    price_low = request.args.get('price_low', type=float)
+    price_high = request.args.get('price_high', type=float)
+    if category:
+        return Product.find_by_category(category)
+    elif name:
+        return Product.find_by_name(name)
+    elif price and int(price) in PRICE_RANGES:  # query price by range
+        return Product.find_by_price(*PRICE_RANGES[int(price)])
+    elif price_low is not None or price_high is not None:
+        return Product.find_by_price(price_low, price_high)
+    app.logger.info('Processing all Products')
+    return Product.query
+
+
+def delete_query(args):
+    """ Selects the Products that match every filter of a bulk delete """
+    query = Product.query
+    if args['category'] is not None:
+        query = query.filter(Product.category == args['category'])
+    if args['name'] is not None:
+        query = query.filter(Product.name == args['name'])
+    if args['price'] is not None:
+        query = query.filter(*Product.price_conditions(*PRICE_RANGES[args['price']]))
+    query = query.filter(*Product.price_conditions(args['price_low'], args['price_high']))
+    if args['max_stock'] is not None:
+        query = query.filter(Product.stock_expression() <= args['max_stock'])
+    return query
+
+
+def price_boundaries(query):
+    """ Reads the price boundaries of the facets from the request """
+    buckets = request.args.get('price_buckets', 'auto')
+    if buckets == 'auto':
+        count = integer_arg('buckets', FACET_PRICE_BUCKETS)
+        if count > FACET_MAX_BUCKETS:
+            raise DataValidationError('Invalid price buckets: at most {} buckets'.format(
+                FACET_MAX_BUCKETS))
+        return Product.price_boundaries(*Product.price_range(query), count=count)
+    try:
+        boundaries = [float(boundary) for boundary in buckets.split(',') if boundary]
+    except ValueError:
+        raise DataValidationError('Invalid price buckets: {}'.format(buckets))
+    if len(boundaries) >= FACET_MAX_BUCKETS:
+        raise DataValidationError('Invalid price buckets: at most {} buckets'.format(
+            FACET_MAX_BUCKETS))
+    if not all(math.isfinite(boundary) for boundary in boundaries):
+        raise DataValidationError('Invalid price buckets: {}'.format(buckets))
+    if boundaries != sorted(set(boundaries)):
+        raise DataValidationError('Invalid price buckets: boundaries must be ascending')
+    return boundaries
+
+
+def parse_timestamp(value):
+    """ Parses an ISO 8601 timestamp into a naive UTC datetime """
+    try:
+        timestamp = inputs.datetime_from_iso8601(value)
+    except ValueError:
+        raise DataValidationError('Invalid timestamp: {}'.format(value))
+    if timestamp.tzinfo:
+        timestamp = timestamp.astimezone(timezone.utc).replace(tzinfo=None)
+    return timestamp
+
+
+def check_body(validator, data):
+    """ Rejects a request body with every error found in it """
+    errors = validator.validate(data)
+    if errors:
+        raise DataValidationError('Invalid product: ' + ', '.join(errors), errors)
 
 
 def check_content_type(content_type):
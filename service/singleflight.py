@@ -0,0 +1,101 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Single flight reads
+Identical reads that arrive while one is running wait for its result instead
+of running the same query again, so a burst of requests for a popular
+Product costs the database one query per worker. A caller that has waited
+longer than the timeout runs the read itself, so that one slow read does
+not hold up every request behind it
+"""
+
+import logging
+import threading
+
+logger = logging.getLogger('app')
+
+
+class _Call(object):
+    """ A read in progress and the result it ends with """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+        self.shared = 0
+
+
+class Group(object):
+    """ Runs one read at a time per key and hands its result to the callers that wait """
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self.calls = {}
+        self.lock = threading.Lock()
+
+    def do(self, key, read):
+        """
+        Returns the result of read, or of the identical read already running
+        The result is shared, so callers must not change it; an exception of
+        the read is raised in every caller
+        """
+        with self.lock:
+            call = self.calls.get(key)
+            leader = call is None
+            if leader:
+                call = self.calls[key] = _Call()
+            else:
+                call.shared += 1
+        if not leader:
+            if not call.done.wait(self.timeout):
+                logger.warning('Read of %s took over %s seconds, reading again', key,
+                               self.timeout)
+                return read()
+            if call.error is not None:
+                raise call.error
+            return call.result
+        try:
+            call.result = read()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self.lock:
+                if self.calls.get(key) is call:
+                    del self.calls[key]
+            call.done.set()
+            if call.shared:
+                logger.debug('Shared %s with %d requests', key, call.shared)
+        return call.result
+
+    def forget(self):
+        """ Lets the reads that arrive from now on start over """
+        with self.lock:
+            self.calls.clear()
+
+
+group = Group()
+
+
+def init_singleflight(app):
+    """ Sets up the group that identical reads share """
+    global group
+    group = Group(app.config['SINGLEFLIGHT_TIMEOUT'])
+    return group
+
+
+def changed(kind):
+    """ Keeps reads that arrive after a write from sharing a result read before it """
+    group.forget()
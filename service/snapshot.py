@@ -0,0 +1,169 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Catalog snapshot
+The unfiltered listing of GET /products is written to a file a moment after
+the last write to the Products, or after at most a maximum wait while the
+writes keep coming, and every worker serves it from that file
+without touching the database. A new version is written next to the current
+one and renamed over it, so readers see either the old or the new catalog
+and requests that already opened the old file finish with it.
+"""
+
+import os
+import time
+import logging
+import tempfile
+import threading
+from datetime import datetime, timezone
+
+logger = logging.getLogger('app')
+
+FILENAME = 'products.json'
+
+
+class Snapshot(object):
+    """
+    Writes the catalog to a file once the writes have paused for delay
+    seconds, and at the latest max_wait seconds after the first write that
+    is not in it
+    """
+
+    def __init__(self, directory, delay, render, max_wait=None):
+        self.directory = directory
+        self.path = os.path.join(directory, FILENAME)
+        self.delay = delay
+        self.max_wait = delay if max_wait is None else max(delay, max_wait)
+        self.render = render
+        self.timer = None
+        # a write of this worker is not in the snapshot yet
+        self.pending = False
+        # when the first write that no rebuild has started on came in
+        self.since = None
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    def schedule(self):
+        """
+        Rebuilds the snapshot once the writes have paused for delay seconds,
+        but no later than max_wait seconds after the first of them
+        """
+        with self.lock:
+            now = time.monotonic()
+            if self.since is None:
+                self.since = now
+            if self.timer is not None:
+                self.timer.cancel()
+            self.pending = True
+            delay = max(0, min(self.delay, self.since + self.max_wait - now))
+            self.timer = threading.Timer(delay, self.rebuild)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def rebuild(self):
+        """ Writes a new version of the snapshot and swaps it in """
+        with self.lock:
+            timer = self.timer
+            # the writes from now on may not be in this version
+            self.since = None
+        try:
+            body = self.render()
+            handle, temporary = tempfile.mkstemp(prefix='.products-', dir=self.directory)
+            try:
+                with os.fdopen(handle, 'wb') as output:
+                    output.write(body)
+                    output.flush()
+                    os.fsync(output.fileno())
+                os.replace(temporary, self.path)
+            except BaseException:
+                os.unlink(temporary)
+                raise
+            logger.info('Wrote catalog snapshot of %d bytes', len(body))
+        except Exception as error:  # pylint: disable=broad-except
+            # the listing falls back to the database while there is no snapshot
+            logger.error('Could not write the catalog snapshot: %s', error)
+            self.discard()
+        with self.lock:
+            if self.timer is timer:
+                self.pending = False
+
+    def written(self):
+        """ When the current version was written, as a UTC time, or None """
+        try:
+            stamp = os.stat(self.path).st_mtime
+        except FileNotFoundError:
+            return None
+        return datetime.fromtimestamp(stamp, timezone.utc).replace(tzinfo=None)
+
+    def discard(self):
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+
+    def open(self):
+        """
+        Opens the current version of the snapshot
+        Returns the file and its version, or None when there is no snapshot
+        or it misses a write of this worker
+        """
+        if self.pending:
+            return None
+        try:
+            snapshot = open(self.path, 'rb')
+        except FileNotFoundError:
+            return None
+        stat = os.fstat(snapshot.fileno())
+        return snapshot, '{:x}-{:x}'.format(stat.st_ino, stat.st_mtime_ns)
+
+    def cancel(self):
+        with self.lock:
+            if self.timer is not None:
+                self.timer.cancel()
+                self.timer = None
+
+
+snapshot = None
+
+
+def init_snapshot(app, render, last_change):
+    """
+    Sets up the snapshot when CATALOG_SNAPSHOT is on and writes a version
+    The file that the other workers serve is only dropped when the catalog
+    changed after it was written; last_change returns when that was
+    """
+    global snapshot
+    if snapshot is not None:
+        snapshot.cancel()
+        snapshot = None
+    if not app.config['CATALOG_SNAPSHOT']:
+        return None
+    snapshot = Snapshot(app.config['CATALOG_SNAPSHOT_DIR'],
+                        app.config['CATALOG_SNAPSHOT_DELAY'], render,
+                        app.config['CATALOG_SNAPSHOT_MAX_WAIT'])
+    written = snapshot.written()
+    changed_at = last_change()
+    if written is not None and changed_at is not None and changed_at >= written:
+        logger.info('Catalog snapshot of %s is stale', written)
+        snapshot.discard()
+    # this worker serves from the database until its own version is written
+    snapshot.schedule()
+    return snapshot
+
+
+def changed(kind):
+    """ Tells the snapshot that the Products changed """
+    if snapshot is not None:
+        snapshot.schedule()
@@ -4,7 +4,18 @@ $(function () {
     //  U T I L I T Y   F U N C T I O N S
     // ****************************************
 
-    var $api_key = "c38e5e9781dd46cb8eba2299c363bfe7";
+    // The API key is entered by the operator and kept for the browser session
+    $("#api_key").val(sessionStorage.getItem("api_key") || "");
+    $("#api_key").change(function () {
+        sessionStorage.setItem("api_key", $("#api_key").val());
+    });
+
+    // Headers of a write, which needs the API key
+    function api_headers() {
+        return {
+            'X-Api-Key': $("#api_key").val()
+        };
+    }
 
     // Updates the form with data from the response
     function update_form_data(res) { //response object
@@ -50,9 +61,7 @@ $(function () {
             "description" : description
         };
 
-        var headers = {
-            'X-Api-Key': $api_key
-        };
+        var headers = api_headers();
 
         var ajax = $.ajax({
             type: "POST",
@@ -63,6 +72,7 @@ $(function () {
         });
 
         ajax.done(function(res){
+            clear_page_cache()
             update_form_data(res)
             flash_message("Success")
         });
@@ -94,9 +104,7 @@ $(function () {
             "description": description
         };
 
-        var headers = {
-            'X-Api-Key': $api_key
-        };
+        var headers = api_headers();
 
         var ajax = $.ajax({
                 type: "PUT",
@@ -107,6 +115,7 @@ $(function () {
             })
 
         ajax.done(function(res){
+            clear_page_cache()
             update_form_data(res)
             flash_message("Success")
         });
@@ -153,9 +162,7 @@ $(function () {
 
         var product_id = $("#product_id").val();
 
-        var headers = {
-            'X-Api-Key': $api_key
-        };
+        var headers = api_headers();
 
         var ajax = $.ajax({
             type: "DELETE",
@@ -166,6 +173,7 @@ $(function () {
         })
 
         ajax.done(function(res){
+            clear_page_cache()
             clear_form_data()
             flash_message("Product has been Deleted!")
         });
@@ -185,77 +193,170 @@ $(function () {
     });
 
     // ****************************************
-    // Search for a Product
+    // Search for Products
     // ****************************************
 
-    $("#search-btn").click(function () {
+    var PAGE_SIZE = 50;
+    var ROW_HEIGHT = 37;        // px, every result row has this height
+    var OVERSCAN = 10;          // rows rendered above and below the visible ones
+    var SEARCH_DELAY = 300;     // ms of no typing before a search starts
+    var PAGE_CACHE_SIZE = 100;  // pages kept for searches that are repeated
+    var FIELDS = "id,name,category,price,stock,description";
+
+    var page_cache = {};        // url of a page -> its response
+    var page_cache_urls = [];   // urls of the cached pages, oldest first
+    var results = [];           // products of the pages loaded so far
+    var next_url = null;        // the next page of the search, null at the end
+    var loading = false;
+    var search_id = 0;          // pages of a search that was replaced are dropped
+    var search_timer = null;
+    var render_pending = false;
+
+    // Escapes text for HTML
+    function escape_html(value) {
+        return $("<div>").text(value === null || value === undefined ? "" : value).html();
+    }
 
+    // Builds the url of the first page of the search in the form
+    function search_url() {
+        var query = {sort: "id", limit: PAGE_SIZE, fields: FIELDS};
         var name = $("#product_name").val();
         var category = $("#product_category").val();
         var price = $("#product_price").val();
-
-        var queryString = ""
-
         if (name) {
-            queryString += '?name=' + name
+            query.name = name;
         }
         if (category) {
-            if (queryString.length > 0) {
-                queryString += '&category=' + category
-            } else {
-                queryString += '?category=' + category
-            }
+            query.category = category;
         }
         if (price) {
-            if (queryString.length > 0) {
-                queryString += '&price=' + price
-            }
-            else {
-                queryString += '?price=' + price
-            }
+            query.price = price;
         }
+        return "/products?" + $.param(query);
+    }
 
+    // Forgets the cached pages, after a write changed the products
+    function clear_page_cache() {
+        page_cache = {};
+        page_cache_urls = [];
+    }
+
+    // Fetches a page, from the cache when it was fetched before
+    function fetch_page(url, done, fail) {
+        if (page_cache.hasOwnProperty(url)) {
+            done(page_cache[url]);
+            return;
+        }
         var ajax = $.ajax({
             type: "GET",
-            url: "/products" + queryString,
+            url: url,
             contentType: "application/json",
             data: ''
         })
 
         ajax.done(function(res){
-            //alert(res.toSource())
-            $("#res_data").empty();
-            var header = '<tr>'
-            header += '<th class="col-md-1">ID</th>'
-            header += '<th class="col-md-3">Name</th>'
-            header += '<th class="col-md-3">Category</th>'
-            header += '<th class="col-md-2">Price</th>'
-            header += '<th class="col-md-2">Stock</th>'
-            header += '<th class="col-md-4">Description</th></tr>'
-            $("#res_data").append(header);
-            var firstProduct = "";
-            for(var i = 0; i < res.length; i++) {
-                var product = res[i];
-                var row = '<tr><td class="col-md-1">'+product.id+'</td><td class="col-md-3">'+product.name+'</td><td class="col-md-3">'+product.category+'</td><td class="col-md-2">'+
-                product.price+'</td><td class="col-md-2">'+product.stock+'</td><td class="col-md-4">'+product.description+"</td></tr>";
-                $("#res_data").append(row);
-                if (i == 0) {
-                    firstProduct = product;
-                }
+            page_cache[url] = res;
+            page_cache_urls.push(url);
+            if (page_cache_urls.length > PAGE_CACHE_SIZE) {
+                delete page_cache[page_cache_urls.shift()];
             }
+            done(res);
+        });
 
-            // copy the first result to the form
-            if (firstProduct != "") {
-                update_form_data(firstProduct)
+        ajax.fail(fail);
+    }
+
+    // Loads a page of a search and adds its products to the results
+    function load_page(url, id, done) {
+        loading = true;
+        fetch_page(url, function (page) {
+            if (id != search_id) {
+                return;
+            }
+            loading = false;
+            results = results.concat(page.products);
+            next_url = page.next;
+            render_rows();
+            if (done) {
+                done();
             }
+        }, function (res) {
+            if (id != search_id) {
+                return;
+            }
+            loading = false;
+            flash_message(res.responseJSON ? res.responseJSON.message : "Server error!")
+        });
+    }
+
+    function product_row(product) {
+        return '<tr><td>' + escape_html(product.id) + '</td><td>' + escape_html(product.name) +
+            '</td><td>' + escape_html(product.category) + '</td><td>' + escape_html(product.price) +
+            '</td><td>' + escape_html(product.stock) + '</td><td>' +
+            escape_html(product.description) + '</td></tr>';
+    }
+
+    function spacer_row(rows) {
+        return rows > 0 ? '<tr style="height: ' + rows * ROW_HEIGHT + 'px"><td colspan="6"></td></tr>' : '';
+    }
+
+    // Renders only the rows in view, with spacers that keep the scroll height
+    function render_rows() {
+        var $viewport = $("#results_viewport");
+        var top = $viewport.scrollTop();
+        var first = Math.max(0, Math.floor(top / ROW_HEIGHT) - OVERSCAN);
+        var last = Math.min(results.length,
+            Math.ceil((top + $viewport.height()) / ROW_HEIGHT) + OVERSCAN);
+        var rows = [spacer_row(first)];
+        for (var i = first; i < last; i++) {
+            rows.push(product_row(results[i]));
+        }
+        rows.push(spacer_row(results.length - last));
+        $("#results_body").html(rows.join(""));
+        $("#results_count").text(results.length + (next_url ? "+" : "") + " products");
+
+        // fetch the next page before the end of the loaded rows comes into view
+        if (next_url && !loading && last + OVERSCAN >= results.length) {
+            load_page(next_url, search_id);
+        }
+    }
 
+    // Starts a search from its first page, copying the first product to the form when asked
+    function start_search(copy_first) {
+        clearTimeout(search_timer);
+        search_id += 1;
+        results = [];
+        next_url = null;
+        $("#results_viewport").scrollTop(0);
+        load_page(search_url(), search_id, function () {
+            if (copy_first && results.length > 0) {
+                update_form_data(results[0])
+            }
             flash_message("Success")
         });
+    }
 
-        ajax.fail(function(res){
-            flash_message(res.responseJSON.message)
-        });
+    $("#search-btn").click(function () {
+        start_search(true);
+    });
+
+    // search as the filters are typed, once the typing stops
+    $("#product_name, #product_category, #product_price").on("input", function () {
+        clearTimeout(search_timer);
+        search_timer = setTimeout(function () {
+            start_search(false);
+        }, SEARCH_DELAY);
+    });
 
+    $("#results_viewport").on("scroll", function () {
+        if (render_pending) {
+            return;
+        }
+        render_pending = true;
+        window.requestAnimationFrame(function () {
+            render_pending = false;
+            render_rows();
+        });
     });
 
     // ****************************************
@@ -274,6 +375,7 @@ $(function () {
         })
 
         ajax.done(function(res){
+            clear_page_cache()
             update_form_data(res)
             flash_message("Success")
         });
@@ -0,0 +1,127 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Validation of request bodies against the API models
+A Validator is compiled once from a flask-restplus model into one check per
+field, taken from the type, required flag and min, max, exclusiveMin,
+exclusiveMax, min_length and max_length of the field. Numbers must be
+finite. Checks collect every error of an item instead of stopping at the
+first, and a list of items is checked in a single pass.
+"""
+
+import math
+from flask_restplus import fields
+
+# The value of a field that an item leaves out
+MISSING = object()
+
+
+def _type_check(field):
+    """ Returns the Python types a field accepts and how to name them """
+    if isinstance(field, fields.Integer):
+        return (int,), 'an integer'
+    if isinstance(field, fields.NumberMixin):
+        return (int, float), 'a number'
+    if isinstance(field, fields.String):
+        return (str,), 'a string'
+    if isinstance(field, fields.Boolean):
+        return (bool,), 'a boolean'
+    if isinstance(field, fields.List):
+        return (list,), 'a list'
+    return None, None
+
+
+def compile_field(name, field, nullable=True):
+    """
+    Compiles the checks of a field into one function
+    The function returns the list of errors of a value, empty when it is valid
+    An optional field that is not nullable may be left out but not be null
+    """
+    types, kind = _type_check(field)
+    # bool is an int in Python but not a number in JSON
+    reject_bool = types is not None and bool not in types
+    minimum = getattr(field, 'minimum', None)
+    maximum = getattr(field, 'maximum', None)
+    exclusive_min = getattr(field, 'exclusiveMinimum', None)
+    exclusive_max = getattr(field, 'exclusiveMaximum', None)
+    min_length = getattr(field, 'min_length', None)
+    max_length = getattr(field, 'max_length', None)
+    required = field.required
+
+    def check(value):
+        if value is MISSING or value is None:
+            if required:
+                return ['{} is required'.format(name)]
+            if value is None and not nullable:
+                return ['{} must not be null'.format(name)]
+            return []
+        if types is not None and (not isinstance(value, types) or
+                                  (reject_bool and isinstance(value, bool))):
+            return ['{} must be {}'.format(name, kind)]
+        # JSON bodies may hold NaN and Infinity, which compare false to any bound
+        if isinstance(value, float) and not math.isfinite(value):
+            return ['{} must be a finite number'.format(name)]
+        errors = []
+        if minimum is not None and (value <= minimum if exclusive_min else value < minimum):
+            errors.append('{} must be {} {}'.format(
+                name, 'more than' if exclusive_min else 'at least', minimum))
+        if maximum is not None and (value >= maximum if exclusive_max else value > maximum):
+            errors.append('{} must be {} {}'.format(
+                name, 'less than' if exclusive_max else 'at most', maximum))
+        if min_length is not None and len(value) < min_length:
+            errors.append('{} must not be empty'.format(name) if min_length == 1 else
+                          '{} must be at least {} characters'.format(name, min_length))
+        if max_length is not None and len(value) > max_length:
+            errors.append('{} must be at most {} characters'.format(name, max_length))
+        return errors
+    return check
+
+
+class Validator(object):
+    """
+    Checks dictionaries against a model
+    Fields that are not in the model are ignored, or reported when strict.
+    nullable names the optional fields that may be null, every one of them
+    when it is None
+    """
+
+    def __init__(self, model, strict=False, nullable=None):
+        # resolved includes the fields a model inherits
+        self.checks = [(name, compile_field(name, field,
+                                            nullable is None or name in nullable))
+                       for name, field in model.resolved.items() if not field.readonly]
+        self.names = frozenset(name for name, _ in self.checks)
+        self.strict = strict
+
+    def validate(self, item):
+        """ Returns every error of an item, an empty list when it is valid """
+        if not isinstance(item, dict):
+            return ['must be an object']
+        errors = []
+        for name, check in self.checks:
+            errors.extend(check(item.get(name, MISSING)))
+        if self.strict and not self.names.issuperset(item):
+            errors.extend('{} is not a field'.format(name)
+                          for name in sorted(set(item) - self.names))
+        return errors
+
+    def validate_many(self, items):
+        """ Returns the index and errors of every item that is not valid """
+        invalid = []
+        for index, item in enumerate(items):
+            errors = self.validate(item)
+            if errors:
+                invalid.append({'index': index, 'errors': errors})
+        return invalid
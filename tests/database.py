@@ -0,0 +1,89 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test fixture that rolls back the database after every test
+
+The tables are created once per test class. Every test then runs inside a
+transaction on a single connection that is rolled back when it ends, and
+the commits of the code under test only release a SAVEPOINT.
+Tests run against an in-memory SQLite database unless DATABASE_URI is set,
+so they need no database server and can run in parallel processes.
+"""
+import os
+import unittest
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from service import app, changes
+from service.model import Product, db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite://')
+
+
+class TransactionalTestCase(unittest.TestCase):
+    """ Base class of the tests that use the database """
+
+    # every process of nosetests --processes sets up a database of its own
+    _multiprocess_can_split_ = True
+
+    @classmethod
+    def setUpClass(cls):
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        app.config['CHANGE_FEED_BROKER'] = 'local'
+        Product.init_db(app)
+        db.drop_all()
+        db.create_all()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+        db.get_engine(app).dispose()
+
+    def setUp(self):
+        changes.init_changes(app, db.engine, db.session)
+        db.session.remove()
+        self.connection = db.engine.connect()
+        self.transaction = self.connection.begin()
+        # every session of the test, including the ones the requests
+        # open after the last was removed, joins the outer transaction
+        registry = db.session.registry
+        self.createfunc = registry.createfunc
+        registry.createfunc = lambda: db.session.session_factory(bind=self.connection,
+                                                                 binds={})
+        db.session.remove()
+        event.listen(Session, 'after_begin', self.begin_savepoint)
+        event.listen(Session, 'after_transaction_end', self.restart_savepoint)
+
+    def tearDown(self):
+        event.remove(Session, 'after_transaction_end', self.restart_savepoint)
+        event.remove(Session, 'after_begin', self.begin_savepoint)
+        db.session.remove()
+        db.session.registry.createfunc = self.createfunc
+        self.transaction.rollback()
+        self.connection.close()
+
+    @staticmethod
+    def begin_savepoint(session, transaction, connection):
+        """ Puts the work of a new session in a SAVEPOINT """
+        if transaction.parent is None and not transaction.nested:
+            session.begin_nested()
+
+    @staticmethod
+    def restart_savepoint(session, transaction):
+        """ Opens a new SAVEPOINT when the code under test ends one """
+        if transaction.nested and transaction.parent is not None \
+                and transaction.parent.parent is None and session.is_active:
+            session.expire_all()
+            session.begin_nested()
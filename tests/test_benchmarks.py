@@ -0,0 +1,96 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Benchmarks
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import io
+import argparse
+import unittest
+from benchmarks.load import parse_mix, percentile, Recorder
+from benchmarks.micro import compare
+from benchmarks.catalog import generate, write_csv, CATEGORIES
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLoad(unittest.TestCase):
+    """ Test Cases for the Load Test """
+
+    def test_parse_mix(self):
+        """ Parse the weights of a traffic mix """
+        self.assertEqual(parse_mix('get=3, buy'), {'get': 3, 'buy': 1})
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, 'delete=1')
+        self.assertRaises(argparse.ArgumentTypeError, parse_mix, 'get=0')
+
+    def test_percentile(self):
+        """ Pick percentiles by nearest rank """
+        ordered = list(range(1, 101))
+        self.assertEqual(percentile(ordered, 0.5), 50)
+        self.assertEqual(percentile(ordered, 0.99), 99)
+        self.assertEqual(percentile([7], 0.95), 7)
+        self.assertIsNone(percentile([], 0.5))
+
+    def test_report(self):
+        """ Summarize latencies per operation """
+        recorder = Recorder()
+        for millis in range(1, 11):
+            recorder.record('get', millis / 1000.0, True)
+        recorder.record('buy', 0.5, False)
+        report = recorder.report(2)
+        self.assertEqual((report['requests'], report['errors']), (11, 1))
+        self.assertEqual(report['endpoints']['get']['p50_ms'], 5)
+        self.assertEqual(report['endpoints']['get']['throughput'], 5)
+
+
+class TestMicro(unittest.TestCase):
+    """ Test Cases for the Micro-benchmarks """
+
+    def test_compare_with_baseline(self):
+        """ Fail benchmarks that got slower than the threshold """
+        rows, failed = compare({'fast': 1.1, 'slow': 2.0, 'new': 3.0},
+                               {'fast': 1.0, 'slow': 1.0}, 1.3)
+        self.assertTrue(failed)
+        self.assertEqual([row['regressed'] for row in rows], [False, True, False])
+        self.assertIsNone(rows[2]['ratio'])
+        self.assertFalse(compare({'fast': 1.1}, {'fast': 1.0}, 1.3)[1])
+
+
+class TestCatalog(unittest.TestCase):
+    """ Test Cases for the Catalog Generator """
+
+    def test_generate_in_chunks(self):
+        """ Generate a reproducible catalog in bounded chunks """
+        chunks = list(generate(25, seed=3, chunk_size=10))
+        self.assertEqual([len(rows) for rows in chunks], [10, 10, 5])
+        self.assertEqual(chunks, list(generate(25, seed=3, chunk_size=10)))
+        self.assertNotEqual(chunks, list(generate(25, seed=4, chunk_size=10)))
+        names = dict(CATEGORIES)
+        for name, category, price, cents, stock, description, shards, updated_at in chunks[0]:
+            self.assertIn(category, names)
+            self.assertGreater(float(price), 0)
+            self.assertEqual(cents, round(float(price) * 100))
+            self.assertGreaterEqual(stock, 0)
+            self.assertLessEqual(len(name), 50)
+
+    def test_write_csv(self):
+        """ Write a catalog as CSV with a header """
+        output = io.StringIO()
+        self.assertEqual(write_csv(generate(5), output), 5)
+        lines = output.getvalue().splitlines()
+        self.assertEqual(len(lines), 6)
+        self.assertTrue(lines[0].startswith('name,category,price,price_cents,stock'))
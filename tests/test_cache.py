@@ -0,0 +1,77 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Result Cache
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import time
+import unittest
+from unittest.mock import MagicMock, patch
+from werkzeug.datastructures import MultiDict
+from service.cache import MemoryStore, ResultCache
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestResultCache(unittest.TestCase):
+    """ Test Cases for the Result Cache """
+
+    def setUp(self):
+        self.cache = ResultCache(MemoryStore(), 60)
+        self.renders = 0
+
+    def render(self):
+        self.renders += 1
+        return '[{}]'.format(self.renders)
+
+    def test_cache_hit(self):
+        """ Render a listing once for the same filters """
+        params = MultiDict([('category', 'food'), ('name', 'kibble')])
+        self.assertEqual(self.cache.fetch(params, self.render), '[1]')
+        same = MultiDict([('name', 'kibble'), ('price', ''), ('category', 'food')])
+        self.assertEqual(self.cache.fetch(same, self.render), '[1]')
+        self.assertEqual(self.cache.fetch(MultiDict([('category', 'pet')]), self.render), '[2]')
+
+    def test_bump_generation(self):
+        """ Render the listings again after a write """
+        params = MultiDict([('category', 'food')])
+        self.cache.fetch(params, self.render)
+        self.cache.bump()
+        self.assertEqual(self.cache.generation(), 1)
+        self.assertEqual(self.cache.fetch(params, self.render), '[2]')
+
+    def test_broken_store(self):
+        """ Render the listing when the store fails """
+        self.cache.store = MagicMock(get=MagicMock(side_effect=IOError('down')),
+                                     incr=MagicMock(side_effect=IOError('down')))
+        self.assertEqual(self.cache.fetch(MultiDict(), self.render), '[1]')
+        self.cache.bump()
+
+    def test_memory_store(self):
+        """ Expire and evict the values of the memory store """
+        store = MemoryStore(size=2)
+        store.set('a', 'one')
+        store.set('b', 'two', ex=10)
+        store.get('a')
+        store.set('c', 'three')
+        self.assertIsNone(store.get('b'))
+        self.assertEqual(store.get('a'), b'one')
+        self.assertEqual(store.incr('n'), 1)
+        store.set('e', 'five', ex=1)
+        later = time.monotonic() + 2
+        with patch('service.cache.time.monotonic', return_value=later):
+            self.assertIsNone(store.get('e'))
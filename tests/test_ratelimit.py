@@ -0,0 +1,63 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for Rate Limiting
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+from service.ratelimit import Limit, MemoryStore, RateLimiter
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestRateLimit(unittest.TestCase):
+    """ Test Cases for Rate Limiting """
+
+    def test_token_bucket(self):
+        """ Refill a token bucket over time """
+        store = MemoryStore()
+        limit = Limit(2, 3)
+        self.assertEqual([store.take('key', limit, 0)[0] for _ in range(4)],
+                         [True, True, True, False])
+        self.assertEqual(store.take('key', limit, 0)[2], 0.5)
+        self.assertTrue(store.take('key', limit, 0.5)[0])
+        self.assertFalse(store.take('key', limit, 0.5)[0])
+        self.assertEqual(store.take('key', limit, 100)[1], 2)
+
+    def test_evict_idle_buckets(self):
+        """ Drop the buckets of clients that went quiet """
+        store = MemoryStore(2)
+        limit = Limit(1, 1)
+        store.take('old', limit, 0)
+        store.take('busy', limit, 1)
+        store.take('old', limit, 2)
+        store.take('new', limit, 3)
+        self.assertEqual(list(store.buckets), ['old', 'new'])
+
+    def test_parse_limits(self):
+        """ Parse the rate limits of the route classes """
+        limits = Limit.parse_all('read=100:200, buy=5')
+        self.assertEqual((limits['read'].rate, limits['read'].capacity), (100, 200))
+        self.assertEqual((limits['buy'].rate, limits['buy'].capacity), (5, 5))
+
+    def test_unlimited_route_class(self):
+        """ Let requests of route classes without a limit through """
+        limiter = RateLimiter(MemoryStore(), Limit.parse_all('buy=1'))
+        self.assertIsNone(limiter.check('client', 'read'))
+        allowed, headers = limiter.check('client', 'buy')
+        self.assertTrue(allowed)
+        self.assertEqual(headers['X-RateLimit-Remaining'], '0')
@@ -0,0 +1,117 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for Single Flight reads
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import time
+import threading
+import unittest
+from service.singleflight import Group
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSingleFlight(unittest.TestCase):
+    """ Test Cases for Single Flight reads """
+
+    def setUp(self):
+        self.group = Group()
+        self.release = threading.Event()
+        self.reads = 0
+
+    def read(self):
+        self.reads += 1
+        self.release.wait(5)
+        return {'id': self.reads}
+
+    def run_callers(self, count, read, key='product:1'):
+        """ Starts count callers and waits until all but the first have joined """
+        results = []
+
+        def call():
+            try:
+                results.append(self.group.do(key, read))
+            except IOError as error:
+                results.append(error)
+        threads = [threading.Thread(target=call) for _ in range(count)]
+        for thread in threads:
+            thread.start()
+        while True:
+            with self.group.lock:
+                call_in_flight = self.group.calls.get(key)
+                if call_in_flight is not None and call_in_flight.shared == count - 1:
+                    break
+            time.sleep(0.001)
+        self.release.set()
+        for thread in threads:
+            thread.join(5)
+        return results
+
+    def test_share_result(self):
+        """ Run one read for identical concurrent calls """
+        results = self.run_callers(5, self.read)
+        self.assertEqual(self.reads, 1)
+        self.assertEqual(results, [{'id': 1}] * 5)
+        self.assertEqual(self.group.calls, {})
+
+    def test_share_error(self):
+        """ Raise the error of the read in every caller """
+        def fail():
+            self.release.wait(5)
+            raise IOError('database is down')
+        results = self.run_callers(3, fail)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(isinstance(result, IOError) for result in results))
+
+    def test_separate_keys(self):
+        """ Run a read per key """
+        self.release.set()
+        self.group.do('product:1', self.read)
+        self.group.do('product:2', self.read)
+        self.assertEqual(self.reads, 2)
+
+    def test_forget(self):
+        """ Start a new read after a write """
+        started = threading.Event()
+
+        def read():
+            started.set()
+            return self.read()
+        first = threading.Thread(target=self.group.do, args=('product:1', read))
+        first.start()
+        started.wait(5)
+        self.group.forget()
+        self.release.set()
+        self.assertEqual(self.group.do('product:1', self.read), {'id': 2})
+        first.join(5)
+
+    def test_timeout(self):
+        """ Run the read again when the one running takes too long """
+        self.group = Group(timeout=0.05)
+        started = threading.Event()
+
+        def read():
+            started.set()
+            return self.read()
+        first = threading.Thread(target=self.group.do, args=('product:1', read))
+        first.start()
+        started.wait(5)
+        self.assertEqual(self.group.do('product:1', lambda: {'id': 'own'}), {'id': 'own'})
+        self.release.set()
+        first.join(5)
+        self.assertEqual(self.group.calls, {})
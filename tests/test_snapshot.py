@@ -0,0 +1,122 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the Catalog Snapshot
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import os
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from unittest.mock import patch
+from flask import Flask
+from service import snapshot as snapshots
+from service.snapshot import Snapshot
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSnapshot(unittest.TestCase):
+    """ Test Cases for the Catalog Snapshot """
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.body = b'[]'
+        self.snapshot = Snapshot(self.directory.name, 60, lambda: self.body)
+
+    def tearDown(self):
+        self.snapshot.cancel()
+        self.directory.cleanup()
+
+    def test_no_snapshot(self):
+        """ Fall back to the database before the first snapshot """
+        self.assertIsNone(self.snapshot.open())
+
+    def test_rebuild(self):
+        """ Write a snapshot and open it with its version """
+        self.snapshot.rebuild()
+        catalog, version = self.snapshot.open()
+        with catalog:
+            self.assertEqual(catalog.read(), b'[]')
+        self.assertTrue(version)
+        self.assertEqual(os.listdir(self.directory.name), ['products.json'])
+
+    def test_replace_while_open(self):
+        """ Keep serving the old version to the readers that opened it """
+        self.snapshot.rebuild()
+        old, old_version = self.snapshot.open()
+        self.body = b'[{"id": 1}]'
+        self.snapshot.rebuild()
+        new, new_version = self.snapshot.open()
+        with old, new:
+            self.assertEqual(old.read(), b'[]')
+            self.assertEqual(new.read(), b'[{"id": 1}]')
+        self.assertNotEqual(old_version, new_version)
+
+    def test_pending_write(self):
+        """ Skip the snapshot until it includes the last write """
+        self.snapshot.rebuild()
+        self.snapshot.schedule()
+        self.assertIsNone(self.snapshot.open())
+        self.snapshot.cancel()
+        self.snapshot.rebuild()
+        opened = self.snapshot.open()
+        self.assertIsNotNone(opened)
+        opened[0].close()
+
+    def test_failed_render(self):
+        """ Drop the snapshot when the catalog cannot be rendered """
+        self.snapshot.rebuild()
+
+        def fail():
+            raise IOError('database is down')
+        self.snapshot.render = fail
+        self.snapshot.rebuild()
+        self.assertIsNone(self.snapshot.open())
+        self.assertEqual(os.listdir(self.directory.name), [])
+
+    def test_max_wait(self):
+        """ Rebuild within the maximum wait while writes keep coming """
+        self.snapshot.max_wait = 90
+        with patch('service.snapshot.time.monotonic', side_effect=[0, 30, 85]):
+            delays = []
+            for _ in range(3):
+                self.snapshot.schedule()
+                delays.append(self.snapshot.timer.interval)
+        self.assertEqual(delays, [60, 60, 5])
+        self.snapshot.cancel()
+        self.snapshot.rebuild()
+        with patch('service.snapshot.time.monotonic', return_value=100):
+            self.snapshot.schedule()
+        self.assertEqual(self.snapshot.timer.interval, 60)
+
+    def test_keep_fresh_snapshot_at_boot(self):
+        """ Drop the snapshot at boot only when the catalog changed since """
+        app = Flask(__name__)
+        app.config.update(CATALOG_SNAPSHOT=True, CATALOG_SNAPSHOT_DIR=self.directory.name,
+                          CATALOG_SNAPSHOT_DELAY=60, CATALOG_SNAPSHOT_MAX_WAIT=60)
+        self.snapshot.rebuild()
+        written = self.snapshot.written()
+        try:
+            snapshots.init_snapshot(app, lambda: self.body,
+                                    lambda: written - timedelta(seconds=1))
+            self.assertEqual(os.listdir(self.directory.name), ['products.json'])
+            snapshots.init_snapshot(app, lambda: self.body, datetime.utcnow)
+            self.assertEqual(os.listdir(self.directory.name), [])
+        finally:
+            snapshots.snapshot.cancel()
+            snapshots.snapshot = None
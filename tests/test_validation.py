@@ -0,0 +1,83 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for Validation
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import unittest
+from service.service import create_model, patch_model, bulk_patch_model
+from service.validation import Validator
+
+PRODUCT = {'name': 'shampos', 'category': 'Health Care', 'stock': 3,
+           'price': 12.5, 'description': 'Fresh'}
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestValidation(unittest.TestCase):
+    """ Test Cases for Validation """
+
+    def test_valid_product(self):
+        """ Accept a valid Product and ignore extra fields """
+        validator = Validator(create_model)
+        self.assertEqual(validator.validate(PRODUCT), [])
+        self.assertEqual(validator.validate(dict(PRODUCT, id=4, price=12)), [])
+
+    def test_collect_every_error(self):
+        """ Report every error of a Product at once """
+        validator = Validator(create_model)
+        errors = validator.validate({'name': '', 'category': 'x' * 51, 'stock': -1,
+                                     'price': 'free', 'description': None})
+        self.assertEqual(errors, ['name must not be empty', 'price must be a number',
+                                  'stock must be at least 0',
+                                  'description is required',
+                                  'category must be at most 50 characters'])
+        self.assertEqual(validator.validate([]), ['must be an object'])
+        self.assertEqual(validator.validate(dict(PRODUCT, stock=True)),
+                         ['stock must be an integer'])
+
+    def test_validate_many(self):
+        """ Report the errors of every item of a batch with its index """
+        validator = Validator(bulk_patch_model, strict=True)
+        invalid = validator.validate_many([{'id': 1, 'price': 2},
+                                           {'price': -2},
+                                           {'id': 3, 'colour': 'red'}])
+        self.assertEqual(invalid, [
+            {'index': 1, 'errors': ['id is required', 'price must be at least 0']},
+            {'index': 2, 'errors': ['colour is not a field']}
+        ])
+
+    def test_out_of_range_numbers(self):
+        """ Refuse numbers that are not finite or do not fit the columns """
+        validator = Validator(create_model)
+        for price in (float('nan'), float('inf'), float('-inf')):
+            self.assertEqual(validator.validate(dict(PRODUCT, price=price)),
+                             ['price must be a finite number'])
+        self.assertEqual(validator.validate(dict(PRODUCT, price=10 ** 16)),
+                         ['price must be less than 10000000000000000'])
+        self.assertEqual(validator.validate(dict(PRODUCT, price=10 ** 16 - 2.0)), [])
+        self.assertEqual(validator.validate(dict(PRODUCT, stock=2 ** 31)),
+                         ['stock must be at most 2147483647'])
+
+    def test_null_fields(self):
+        """ Refuse null for the fields that are not nullable """
+        validator = Validator(patch_model, strict=True, nullable=('description',))
+        self.assertEqual(validator.validate({'description': None}), [])
+        self.assertEqual(validator.validate({'name': None, 'category': None, 'price': None}),
+                         ['name must not be null', 'price must not be null',
+                          'category must not be null'])
+        self.assertEqual(validator.validate({}), [])